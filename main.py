@@ -1,716 +1,2649 @@
+import abc
 import asyncio
+import base64
+import codecs
+import functools
+import hashlib
+import io
 import logging
+import math
+import os
+import pickle
 import aiohttp
 import urllib.parse
 import json
+import random
 import re
-from astrbot.api.all import AstrMessageEvent, CommandResult, Context, Plain
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from astrbot.api.all import AstrMessageEvent, CommandResult, Context, MessageChain, Plain
 import astrbot.api.event.filter as filter
 from astrbot.api.star import register, Star
 from astrbot.api.message_components import Image as MsgImage, Reply
 
+try:
+    from PIL import Image as PILImage, ImageDraw, ImageFont, ImageOps
+except ImportError:  # Pillow不可用时只使用HTML渲染，图片不做预处理
+    PILImage = ImageDraw = ImageFont = ImageOps = None
+
+try:
+    from rapidocr_onnxruntime import RapidOCR
+except ImportError:  # 未安装本地OCR引擎时只使用远程OCR接口
+    RapidOCR = None
+
 logger = logging.getLogger("astrbot")
 
+# HTTP连接池配置（按上游主机分别建立长连接会话）
+HTTP_POOL_LIMIT = 100  # 单个主机会话的总连接数上限
+HTTP_POOL_LIMIT_PER_HOST = 32  # 单个主机的并发连接数下限，主机隔离舱允许更多并发时按隔离舱放大
+HTTP_DNS_CACHE_TTL = 300  # DNS缓存时间（秒）
+HTTP_KEEPALIVE_TIMEOUT = 60  # 空闲连接保活时间（秒）
 
-@register("D-G-N-C-J", "Tinyxi", "腾讯元宝+DeepSeek-3.2+DeepSeek-3.1+GPT5-nano+Claude4.5-hiku+Qwen3-coder+DeepSeek-R1+智谱GLM4.6+夸克AI+蚂蚁AI+豆包AI+ChatGPT-oss+谷歌Gemini-2.5+阿里AI+讯飞AI", "1.0.0", "")
-class Main(Star):
-    def __init__(self, context: Context) -> None:
-        super().__init__(context)
-        self.waiting_sessions = {}  # 存储等待图片的会话
-        self.timeout_tasks = {}  # 存储超时任务
+# 回答缓存配置（仅用于不带记忆数的单次问答模型）
+ANSWER_CACHE_MAX_ENTRIES = 512  # 最多缓存的回答条数
+ANSWER_CACHE_MAX_BYTES = 4 * 1024 * 1024  # 缓存回答的总字节数上限
 
-    @filter.command("腾讯元宝")
-    async def tencent_yuanbao(self, message: AstrMessageEvent):
-        """腾讯元宝助手，支持异步请求"""
-        msg = message.message_str.replace("腾讯元宝", "").strip()
-        
-        if not msg:
-            return CommandResult().error("正确指令：腾讯元宝 <提问内容>\n\n示例：腾讯元宝 1+1")
-        
-        question = msg.strip()
-        
-        # 添加提示词
-        prompt = f"{question}\n\n注意：这是回答QQ平台的问题，请注意违禁词，避免涉政，涉黄，暴力，血腥，反人类，反人伦。"
-        
-        api_url = "https://api.jkyai.top/API/yuanbao.php"
-        params = {
-            "question": prompt
+# 附加在每个提问后的违禁词提示
+SAFETY_PROMPT = "注意：这是回答QQ平台的问题，请注意违禁词，避免涉政，涉黄，暴力，血腥，反人类，反人伦。"
+
+
+@dataclass(frozen=True)
+class RequestPolicy:
+    """上游请求策略：有限次重试（指数退避+抖动）和可选的对冲请求，整体不超过请求超时时间"""
+    max_retries: int = 0  # 最多重试次数，只用于幂等的GET请求
+    backoff_base: float = 0.5  # 首次重试的退避上限（秒），之后按2的指数增长
+    backoff_max: float = 4.0  # 单次退避的最长时间（秒）
+    hedge: bool = False  # 请求耗时超过近期P95时，是否再发一个相同请求并取先返回的结果
+    hedge_min_delay: float = 1.0  # 对冲请求的最短等待时间（秒）
+
+
+NO_RETRY_POLICY = RequestPolicy()
+# 单次问答模型的请求是幂等的，可以安全地重试和对冲
+STATELESS_POLICY = RequestPolicy(max_retries=2, hedge=True)
+# 解题接口耗时长，只重试一次，不做对冲
+SOLVER_POLICY = RequestPolicy(max_retries=1)
+HEDGE_MIN_SAMPLES = 20  # 接口至少有多少个耗时样本后才启用对冲请求
+
+
+@dataclass(frozen=True)
+class ModelSpec:
+    """单个大模型指令的注册信息"""
+    command: str  # 触发指令
+    name: str  # 助手名称，用于提示信息
+    title: str  # 大模型菜单中显示的描述
+    endpoint: str  # 接口地址
+    param: str = "question"  # 提问内容对应的参数名
+    needs_uid: bool = False  # 是否需要6位数字记忆数
+    timeout: int = 60  # 请求超时时间（秒）
+    concurrency: int = 8  # 并发请求预算
+    prompt_sep: str = " "  # 提问内容与违禁词提示之间的分隔符
+    cache_ttl: int = 600  # 回答缓存有效期（秒），0表示不缓存；记忆模型始终不缓存
+    policy: RequestPolicy = STATELESS_POLICY  # 请求策略；记忆模型的请求会改变云端记忆，始终不重试
+    stream: bool = False  # 是否在支持的平台上边接收边分段发送回答
+
+
+# 大模型注册表，顺序即大模型菜单中的显示顺序
+MODEL_REGISTRY = (
+    ModelSpec("腾讯元宝", "腾讯元宝助手", "腾讯元宝助手", "https://api.jkyai.top/API/yuanbao.php", timeout=30, prompt_sep="\n\n"),
+    ModelSpec("deep3.2", "DeepSeek-3.2助手", "DeepSeek-3.2助手", "https://api.jkyai.top/API/depsek3.2.php", prompt_sep="\n\n"),
+    ModelSpec("deep3.1", "DeepSeek-3.1助手", "DeepSeek-3.1助手", "https://api.jkyai.top/API/depsek3.1.php", prompt_sep="\n\n"),
+    ModelSpec("gpt5", "GPT5-nano助手", "GPT5-nano助手", "https://api.jkyai.top/API/gpt5-nano/index.php", needs_uid=True, prompt_sep="\n\n"),
+    ModelSpec("克劳德", "Claude4.5-hiku助手", "Claude4.5-hiku助手", "https://api.jkyai.top/API/hiku-4.5/index.php", needs_uid=True, prompt_sep="\n\n"),
+    ModelSpec("千问", "通义千问助手", "通义千问助手", "https://api.jkyai.top/API/qwen3-coder/index.php", needs_uid=True),
+    # 该接口响应速度较慢，设置较长超时时间
+    ModelSpec("deepR1", "DeepSeek-R1助手", "DeepSeek-R1助手", "https://api.jkyai.top/API/deepseek.php", timeout=120, concurrency=4, stream=True),
+    ModelSpec("智谱", "智谱GLM4.6助手", "智谱GLM4.6助手", "https://api.jkyai.top/API/glm4.6.php"),
+    ModelSpec("夸克", "夸克AI助手", "夸克AI助手", "https://api.jkyai.top/API/kkaimx.php", param="content"),
+    ModelSpec("蚂蚁", "蚂蚁AI助手", "蚂蚁Ling2.0-1tAI助手", "https://api.jkyai.top/API/ling-1t.php", timeout=120, concurrency=4, stream=True),
+    ModelSpec("豆包", "豆包AI助手", "字节跳动豆包AI助手", "https://api.jkyai.top/API/doubao.php"),
+    ModelSpec("gpt", "ChatGPT-ossAI助手", "ChatGPT-ossAI助手", "https://api.jkyai.top/API/chatgpt-oss/index.php", needs_uid=True),
+    ModelSpec("谷歌", "谷歌Gemini-2.5AI助手", "谷歌Gemini-2.5AI助手", "https://api.jkyai.top/API/gemini2.5/index.php", needs_uid=True),
+    ModelSpec("阿里", "阿里AI助手", "阿里云千问Qwen3-235bAI助手", "https://api.jkyai.top/API/qwen3.php"),
+    # API文档显示响应耗时较长（6.70s），设置较长超时时间
+    ModelSpec("讯飞", "讯飞AI助手", "讯飞星火X1AI助手", "https://api.jkyai.top/API/xfxhx1.php", param="content", timeout=120, concurrency=4, stream=True),
+    ModelSpec("小米", "小米MiMo-V2助手", "小米MiMo-V2助手", "https://api.jkyai.top/API/xiaomi/index.php", needs_uid=True),
+)
+MODELS = {spec.command: spec for spec in MODEL_REGISTRY}
+
+# 流式回答配置
+STREAM_PLATFORMS = ("aiocqhttp", "telegram", "discord", "lark", "dingtalk", "slack")  # 支持分段主动发送消息的平台
+STREAM_CHUNK_CHARS = 300  # 累积多少字后发送一段
+STREAM_FLUSH_INTERVAL = 5  # 距离上次发送超过多少秒时，即使不足一段也发送（秒）
+MAX_RESPONSE_BYTES = 1024 * 1024  # 单个响应最多读取的字节数，超出部分被截断
+
+# 联网搜索配置
+SEARCH_TIMEOUT = 30  # 所有搜索来源共用的截止时间（秒），到期后只使用已返回的结果
+SEARCH_CANDIDATE_POOL = 20  # 合并去重后参与本地相关度排序的候选结果数
+SEARCH_MAX_RESULTS = 8  # 提供给大模型的搜索结果最多条数
+SEARCH_CONTEXT_BUDGET = 1200  # 提供给大模型的搜索信息总字符数上限（中文约等于token数）
+SEARCH_MIN_SNIPPET_CHARS = 40  # 预算不足时截断片段，剩余预算少于此字符数时不再加入结果
+SEARCH_BM25_K1 = 1.5  # BM25词频饱和参数
+SEARCH_BM25_B = 0.75  # BM25文档长度归一化参数
+SEARCH_LATENCY_BUCKETS = (500, 1000, 2000, 4000)  # 按搜索信息字符数分组统计回答耗时
+
+# 联网模式推测执行配置：同时发起不带搜索信息的直接回答，适合模型本身就能回答的问题
+# "off"（默认）：先搜索再回答；"fastest"：直接回答和联网回答谁先成功用谁；
+# "grace"：直接回答先返回时，联网回答最多再等待SEARCH_SPECULATIVE_GRACE秒，等不到就用直接回答
+# 开启后多数问题可能返回未使用搜索结果的回答，并且每次多一次大模型请求，需要时再手动开启
+SEARCH_SPECULATIVE_MODE = "off"
+SEARCH_SPECULATIVE_MODEL = "deep3.2"  # 直接回答使用的模型指令
+SEARCH_SPECULATIVE_GRACE = 5  # 直接回答就绪后等待联网回答的时间（秒）
+# 问题包含这些词时需要最新信息，不做推测
+SEARCH_FRESHNESS_WORDS = (
+    "今天", "今日", "昨天", "明天", "今年", "去年", "明年", "本周", "本月", "最新", "最近", "目前", "现在", "当前",
+    "刚刚", "近期", "现任", "新任", "冠军", "排名", "榜单", "选举", "新闻", "实时", "价格", "股价", "汇率",
+    "天气", "比分", "赛程", "赛果", "发布会", "上映", "版本",
+)
+SEARCH_FRESHNESS_PATTERN = re.compile(r"20\d{2}")  # 问题中出现具体年份时同样需要最新信息
+# 直接回答包含这些内容时说明模型缺少最新信息，视为无效并继续等待联网回答
+SEARCH_UNSURE_PHRASES = ("无法获取实时", "无法联网", "无法访问互联网", "知识截止", "截至我的知识", "没有实时", "建议查阅最新")
+SEARCH_DEDUPE_SIMILARITY = 0.8  # 标题和片段的相似度（3字片段的Jaccard系数）达到此值视为重复结果
+SEARCH_CACHE_TTL = 300  # 同一问题的搜索结果缓存时间（秒），0表示不缓存
+SEARCH_CACHE_MAX_ENTRIES = 256  # 最多缓存的搜索结果条数
+SEARCH_CACHE_MAX_BYTES = 2 * 1024 * 1024  # 缓存搜索结果的总字节数上限
+SEARCH_TRACKING_PARAMS = ("utm_", "spm", "from", "source")  # 比较URL时忽略的跟踪参数前缀
+
+
+@dataclass(frozen=True)
+class SearchBackend:
+    """单个搜索来源的注册信息"""
+    name: str  # 来源名称，用于统计信息
+    url: str  # 接口地址
+    method: str = "POST"  # 请求方式；POST以JSON发送参数，GET以查询字符串发送
+    query_param: str = "query"  # 搜索内容对应的参数名
+    extra_params: tuple = ()  # 固定附加的参数：((参数名, 值), ...)
+    results_field: str = "results"  # 响应中结果列表的字段名
+    title_field: str = "title"
+    snippet_field: str = "snippet"
+    url_field: str = "url"
+    time_field: str = "publish_time"  # 发布时间字段（ISO格式），没有时留空
+    enabled: bool = True
+
+
+# 联网模式同时查询的搜索来源，合并时按此顺序轮流取各来源的结果
+# 按相关度排序的来源与按日期的是同一个聚合接口，结果大多重复且多占一个主机隔离舱名额，
+# 接入不同的搜索服务之前保持关闭
+SEARCH_BACKENDS = (
+    SearchBackend("聚合搜索（按日期）", "https://uapis.cn/api/v1/search/aggregate",
+                  extra_params=(("timeout_ms", SEARCH_TIMEOUT * 1000), ("sort", "date"))),
+    SearchBackend("聚合搜索（按相关度）", "https://uapis.cn/api/v1/search/aggregate",
+                  extra_params=(("timeout_ms", SEARCH_TIMEOUT * 1000), ("sort", "relevance")), enabled=False),
+)
+
+# 插件数据目录（相对于AstrBot运行目录）
+PLUGIN_DATA_DIR = os.path.join("data", "plugin_data", "d-g-n-c-j")
+
+# 进程池配置（本地绘制、图片预处理等CPU密集任务）
+PROCESS_POOL_WORKERS = 2  # 进程池的进程数
+
+# 多图解题配置
+IMAGE_SOLVE_MAX_IMAGES = 6  # 一次最多处理的图片数
+IMAGE_SOLVE_PARALLELISM = 3  # 同一请求中同时识别和解题的图片数
+IMAGE_SOLVE_LAYOUT = "sheet"  # 多张图片的结果："sheet"合并为一张答题卡，"separate"每题一张图片
+
+# 图片下载与预处理配置
+IMAGE_MAX_DOWNLOAD_BYTES = 10 * 1024 * 1024  # 下载图片的最大字节数
+IMAGE_DOWNLOAD_TIMEOUT = 30  # 下载图片的超时时间（秒）
+OCR_IMAGE_MAX_SIDE = 2048  # 发送给OCR前把图片长边缩小到此像素数以内
+OCR_IMAGE_QUALITY = 85  # 预处理后图片的JPEG质量
+OCR_IMAGE_KEEP_BYTES = 512 * 1024  # 不超过此大小且尺寸合适的JPEG/PNG原样发送
+OCR_SEND_BYTES = True  # 是否把预处理后的图片内容（base64）发送给OCR接口，而不是让接口自行下载原图
+
+# OCR后端配置
+# "auto"：已安装rapidocr_onnxruntime时，小图片优先本地识别，大图片优先远程接口，失败时互为后备
+# "local"：只使用本地引擎，不依赖网络OCR服务；"remote"：只使用远程接口
+OCR_BACKEND = "auto"
+OCR_LOCAL_MAX_BYTES = 2 * 1024 * 1024  # auto模式下优先本地识别的图片大小上限
+OCR_LOCAL_CONCURRENCY = 2  # 同时进行的本地识别数，也是本地识别专用进程池的进程数（不占用共享进程池）
+OCR_LOCAL_MAX_QUEUE = 4  # 本地识别最多排队数，排满时auto模式改用远程接口
+
+# OCR结果缓存配置（按图片内容哈希寻址，同一张图片在不同群转发时URL不同但内容相同）
+OCR_CACHE_MAX_ENTRIES = 1024  # 内存中最多缓存的识别结果数
+OCR_CACHE_MAX_BYTES = 4 * 1024 * 1024  # 内存中缓存的识别结果总字节数上限
+OCR_CACHE_TTL = 7 * 24 * 3600  # 识别结果的有效期（秒）
+OCR_CACHE_DISK = True  # 是否把识别结果持久化到磁盘
+OCR_CACHE_DISK_MAX_ENTRIES = 20000  # 磁盘中最多保存的识别结果数
+OCR_CACHE_PRUNE_INTERVAL = 100  # 每写入多少条结果检查一次磁盘缓存上限（检查需要列出整个目录）
+
+# 渲染结果缓存配置
+RENDER_OPTIONS = {
+    "full_page": True,
+    "type": "jpeg",
+    "quality": 95,
+}
+RENDER_CACHE_MAX_BYTES = 32 * 1024 * 1024  # 内存中缓存的图片总字节数上限
+RENDER_CACHE_DISK = True  # 是否把渲染结果持久化到磁盘，插件重载后仍可复用
+RENDER_CACHE_DISK_MAX_BYTES = 256 * 1024 * 1024  # 磁盘缓存的总字节数上限
+RENDER_CACHE_PRUNE_INTERVAL = 20  # 每写入多少个渲染结果检查一次磁盘缓存上限
+# 渲染引擎："html"使用无头浏览器渲染，"local"使用Pillow直接绘制，"auto"在找到中文字体时优先本地绘制
+RENDER_ENGINE = "auto"
+LOCAL_RENDER_FONTS = (  # 本地绘制使用的中文字体，按顺序查找第一个存在的文件
+    "C:/Windows/Fonts/msyh.ttc",
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/google-noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc",
+    "/System/Library/Fonts/PingFang.ttc",
+)
+LOCAL_RENDER_BOLD_FONTS = (  # 粗体字体，找不到时用描边模拟粗体
+    "C:/Windows/Fonts/msyhbd.ttc",
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Bold.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Bold.ttc",
+    "/usr/share/fonts/google-noto-cjk/NotoSansCJK-Bold.ttc",
+)
+LOCAL_RENDER_VERSION = 1  # 本地绘制样式的版本号，修改绘制代码后递增以使旧的缓存失效
+
+# 图片编码配置：渲染结果按字节预算自适应选择质量，过高的页面拆分为多张图片
+IMAGE_BYTE_BUDGET = 1024 * 1024  # 每张图片的目标字节数
+IMAGE_MAX_PAGE_HEIGHT = 4000  # 单张图片的最大高度（像素）
+IMAGE_QUALITY_STEPS = (90, 80, 70, 60, 50)  # 超出预算时依次尝试的JPEG质量
+IMAGE_MIN_WIDTH = 640  # 最低质量仍超出预算时逐步缩小图片，宽度不小于此值
+
+# 页面渲染调度配置（无头浏览器截图资源有限）
+RENDER_WORKERS = 2  # 同时进行的渲染任务数
+RENDER_MAX_QUEUE = 10  # 最多排队的渲染任务数
+RENDER_QUEUE_TIMEOUT = 30  # 渲染任务最长排队时间（秒）
+
+# 解题流水线配置：各阶段的（工作协程数，最多排队数），不同任务的各阶段可以重叠进行
+PIPELINE_STAGES = {
+    "fetch": ("图片下载", 8, 32),
+    "ocr": ("文字识别", 4, 16),
+    "solve": ("解题", 6, 24),
+    "render": ("图片生成", RENDER_WORKERS, RENDER_MAX_QUEUE),
+}
+
+# 请求截止时间配置（秒）：在指令入口创建，之后的各阶段只能使用剩余的时间
+SOLVE_BUDGET = 150  # 解题助手和图片解题助手从开始处理到发送结果的总时间，多张图片共用
+LIAN_WANG_BUDGET = 60  # 联网模式从收到指令到回答的总时间
+OCR_TIMEOUT = 120  # 单次OCR接口请求的超时上限
+SOLVER_TIMEOUT = 120  # 单次解题接口请求的超时上限
+SOLVER_MIN_BUDGET = 10  # 剩余时间少于此值时不再调用解题接口
+RENDER_RESERVE = 10  # 解题时为图片生成预留的时间，解题接口不能占用
+LLM_MIN_BUDGET = 5  # 联网模式剩余时间少于此值时不再调用大模型
+
+# 图片解题助手等待用户发送图片的配置
+WAITING_TIMEOUT = 30  # 等待时间（秒）
+WAITING_MAX_SESSIONS = 10000  # 最多同时等待的会话数，超出时淘汰最早开始等待的会话
+WAITING_SWEEP_INTERVAL = 1  # 过期检查的合并间隔（秒），间隔内到期的会话一起处理
+
+# “最快”指令同时询问的单次问答模型
+RACE_MODELS = ("deep3.2", "deep3.1", "智谱", "豆包", "阿里")
+
+# 上游主机隔离舱配置：主机 -> (最大并发数, 最大排队数)
+HOST_BULKHEADS = {
+    "api.jkyai.top": (48, 96),
+    "uapis.cn": (8, 16),
+    "api.pearktrue.cn": (4, 8),
+}
+DEFAULT_HOST_BULKHEAD = (16, 32)
+# 接口隔离舱配置：接口地址 -> (最大并发数, 最大排队数)，大模型接口的并发预算来自注册表
+ENDPOINT_BULKHEADS = {
+    spec.endpoint: (spec.concurrency, spec.concurrency * 2) for spec in MODEL_REGISTRY
+}
+ENDPOINT_BULKHEADS.update({
+    "https://api.jkyai.top/API/wnjtzs.php": (6, 12),
+    "https://api.pearktrue.cn/api/ocr/": (4, 8),
+})
+DEFAULT_ENDPOINT_BULKHEAD = (8, 16)
+BULKHEAD_MAX_WAIT = 10  # 排队等待的最长时间（秒），超过后直接返回繁忙提示
+BUSY_MESSAGE = "当前请求人数过多，服务繁忙，请稍后重试"
+
+# 熔断器配置（按接口划分）
+BREAKER_FAILURE_THRESHOLD = 5  # 连续失败多少次后熔断
+BREAKER_RECOVERY_TIMEOUT = 30  # 熔断后多久放行探测请求（秒）
+
+
+class UpstreamStatusError(Exception):
+    """上游接口返回了非200状态码"""
+    def __init__(self, status: int, body: str = ""):
+        super().__init__(f"服务器返回错误状态码：{status}")
+        self.status = status
+        self.body = body
+
+
+class BulkheadFullError(Exception):
+    """隔离舱排队已满或等待超时"""
+    def __init__(self, name: str):
+        super().__init__(f"{name} 当前繁忙")
+        self.name = name
+
+
+class Bulkhead:
+    """隔离舱：限制对某个上游的并发请求数，并限制排队数量和排队时间，超出后快速失败"""
+    def __init__(self, name: str, limit: int, max_queue: int, max_wait: float):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._semaphore = asyncio.Semaphore(limit)
+        self.active = 0  # 正在执行的请求数
+        self.waiting = 0  # 正在排队的请求数
+        self.peak_waiting = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait_seen = 0.0
+
+    @asynccontextmanager
+    async def acquire(self):
+        start = time.monotonic()
+        if not self._semaphore.locked():
+            # 有空闲名额时立即获取，不会挂起
+            await self._semaphore.acquire()
+        else:
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise BulkheadFullError(self.name)
+            self.waiting += 1
+            self.peak_waiting = max(self.peak_waiting, self.waiting)
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.max_wait)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise BulkheadFullError(self.name)
+            finally:
+                self.waiting -= 1
+        
+        waited = time.monotonic() - start
+        self.accepted += 1
+        self.total_wait += waited
+        self.max_wait_seen = max(self.max_wait_seen, waited)
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+
+    def stats(self) -> dict:
+        """返回并发和排队统计"""
+        return {
+            "active": self.active,
+            "limit": self.limit,
+            "waiting": self.waiting,
+            "max_queue": self.max_queue,
+            "peak_waiting": self.peak_waiting,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "avg_wait": self.total_wait / self.accepted if self.accepted else 0.0,
+            "max_wait": self.max_wait_seen,
         }
-        
+
+
+class CircuitOpenError(Exception):
+    """接口处于熔断状态，请求被直接拒绝"""
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"服务暂时不可用，请约{max(1, round(retry_after))}秒后重试")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """熔断器：连续失败达到阈值后打开，打开期间快速失败，冷却后只放行一个探测请求（半开）"""
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int, recovery_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0  # 连续失败次数
+        self.opened_at = 0.0
+        self._probing = False
+        self.total_failures = 0
+        self.rejected = 0
+        self.open_count = 0
+
+    def allow(self) -> bool:
+        """判断是否放行本次请求"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.recovery_timeout:
+                self.rejected += 1
+                return False
+            self.state = self.HALF_OPEN
+            self._probing = False
+        if self.state == self.HALF_OPEN:
+            if self._probing:
+                self.rejected += 1
+                return False
+            self._probing = True
+        return True
+
+    def retry_after(self) -> float:
+        """距离下一次放行探测请求的秒数"""
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.recovery_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.total_failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"接口 {self.name} 连续失败{self.failures}次，已熔断")
+                self.open_count += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self._probing = False
+
+    def release(self):
+        """请求未产生结果（被取消或排队失败）时释放探测名额"""
+        self._probing = False
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "total_failures": self.total_failures,
+            "rejected": self.rejected,
+            "open_count": self.open_count,
+            "retry_after": self.retry_after(),
+        }
+
+
+class LatencyTracker:
+    """记录接口最近成功请求的耗时，用于估算对冲请求的触发时机"""
+    def __init__(self, size: int = 200, min_samples: int = HEDGE_MIN_SAMPLES):
+        self._samples = deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, p: float):
+        """返回耗时的p分位数，样本不足时返回None"""
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+class PipelineStage:
+    """解题流水线中的一个阶段：固定数量的工作协程从有界队列中取任务执行
+
+    调用方通过run()提交任务并等待结果；队列已满时抛出BulkheadFullError。
+    调用方取消等待时，排队中的任务被丢弃，执行中的任务被取消。
+    """
+    def __init__(self, name: str, handler, workers: int, max_queue: int):
+        self.name = name
+        self.handler = handler  # 异步函数：handler(任务) -> 结果
+        self.workers = workers
+        self.max_queue = max_queue
+        self._queue = None  # 首次使用时在事件循环中创建
+        self._tasks = []
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.peak_waiting = 0
+        self._total_wait = 0.0
+        self._started = 0
+        self.latency = LatencyTracker(min_samples=1)  # 任务的执行耗时（不含排队）
+
+    def _ensure_workers(self):
+        if self._queue is None:
+            # 队列长度由run()按实际排队数限制，已交给空闲工作协程但尚未取走的任务不算排队
+            self._queue = asyncio.Queue()
+        self._tasks = [task for task in self._tasks if not task.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.get_running_loop().create_task(self._worker()))
+
+    def waiting(self) -> int:
+        """等待空闲工作协程的任务数"""
+        if self._queue is None:
+            return 0
+        return max(0, self._queue.qsize() - (self.workers - self.active))
+
+    def queue_position(self) -> int:
+        """新任务提交后的排队位置，0表示有空闲的工作协程可以立即执行"""
+        if self._queue is None:
+            return 0
+        return max(0, self._queue.qsize() + 1 - (self.workers - self.active))
+
+    async def run(self, item, on_queued=None):
+        """提交任务并等待结果；需要排队时通过on_queued(阶段名称, 排队位置)通知调用方"""
+        self._ensure_workers()
+        position = self.queue_position()
+        if position > self.max_queue:
+            self.rejected += 1
+            raise BulkheadFullError(self.name)
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((item, future, time.monotonic()))
+        self.peak_waiting = max(self.peak_waiting, self.waiting())
         try:
-            timeout = aiohttp.ClientTimeout(total=30)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(api_url, params=params) as resp:
-                    if resp.status != 200:
-                        return CommandResult().error("请求腾讯元宝助手失败，服务器返回错误状态码")
-                    
-                    result = await resp.text()
-                    
-                    return CommandResult().message(result)
-                        
-        except aiohttp.ClientError as e:
-            logger.error(f"网络连接错误：{e}")
-            return CommandResult().error("无法连接到腾讯元宝助手服务器，请稍后重试或检查网络连接")
-        except asyncio.TimeoutError:
-            logger.error("请求超时")
-            return CommandResult().error("请求超时，请稍后重试")
+            # 任务已经入队，发送排队提示时被取消也要丢弃任务，不能让工作协程为无人等待的任务请求上游
+            if position and on_queued is not None:
+                await on_queued(self.name, position)
+            return await future
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+    async def _worker(self):
+        while True:
+            item, future, queued_at = await self._queue.get()
+            if future.done():
+                # 调用方已放弃等待
+                continue
+            self._started += 1
+            self._total_wait += time.monotonic() - queued_at
+            self.active += 1
+            start = time.monotonic()
+            task = asyncio.ensure_future(self.handler(item))
+            # 调用方取消等待时一并取消执行中的任务
+            future.add_done_callback(lambda f, task=task: task.cancel() if f.cancelled() else None)
+            try:
+                await asyncio.wait({task})
+            finally:
+                self.active -= 1
+            if task.cancelled():
+                continue
+            error = task.exception()
+            if error is None:
+                self.completed += 1
+                self.latency.record(time.monotonic() - start)
+                if not future.done():
+                    future.set_result(task.result())
+            else:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(error)
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "workers": self.workers,
+            "waiting": self.waiting(),
+            "max_queue": self.max_queue,
+            "peak_waiting": self.peak_waiting,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "avg_wait": self._total_wait / self._started if self._started else 0.0,
+        }
+
+
+def is_retryable(error: Exception) -> bool:
+    """网络错误、5xx和429状态码可以重试"""
+    if isinstance(error, UpstreamStatusError):
+        return error.status >= 500 or error.status == 429
+    return isinstance(error, aiohttp.ClientError)
+
+
+async def read_text(resp, limit: int = MAX_RESPONSE_BYTES, on_text=None) -> str:
+    """分块读取响应正文，最多读取limit字节；传入on_text时每解码出一段文本就回调一次"""
+    decoder = codecs.getincrementaldecoder(resp.charset or "utf-8")(errors="replace")
+    parts = []
+    received = 0
+    async for chunk in resp.content.iter_chunked(16 * 1024):
+        if received + len(chunk) > limit:
+            chunk = chunk[:limit - received]
+            logger.warning(f"响应超过{limit}字节，已截断：{resp.url}")
+        received += len(chunk)
+        text = decoder.decode(chunk)
+        if text:
+            parts.append(text)
+            if on_text is not None:
+                await on_text(text)
+        if received >= limit:
+            break
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        parts.append(tail)
+        if on_text is not None:
+            await on_text(tail)
+    return "".join(parts)
+
+
+async def read_bytes(resp, limit: int) -> bytes:
+    """分块读取二进制响应正文，超过limit字节时抛出ImageTooLargeError"""
+    if resp.content_length is not None and resp.content_length > limit:
+        raise ImageTooLargeError(limit)
+    buffer = bytearray()
+    async for chunk in resp.content.iter_chunked(64 * 1024):
+        buffer.extend(chunk)
+        if len(buffer) > limit:
+            raise ImageTooLargeError(limit)
+    return bytes(buffer)
+
+
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+)
+
+
+def sniff_image_type(data: bytes):
+    """根据文件头判断图片格式，返回MIME类型，无法识别时返回None（不信任响应头中的Content-Type）"""
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    for signature, mime in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return mime
+    return None
+
+
+def prepare_ocr_image(data: bytes) -> bytes:
+    """把图片缩小到适合OCR的分辨率并重新压缩为JPEG（在进程池中执行）
+
+    按EXIF方向摆正手机照片并转为灰度；尺寸和大小都合适的JPEG/PNG原样返回。
+    """
+    if PILImage is None:
+        return data
+    image = PILImage.open(io.BytesIO(data))
+    # 摆正和转换后的图片不再带有格式信息，需要先记下原图的格式
+    original_format = image.format
+    if (original_format in ("JPEG", "PNG") and len(data) <= OCR_IMAGE_KEEP_BYTES
+            and max(image.size) <= OCR_IMAGE_MAX_SIDE):
+        return data
+    image = ImageOps.exif_transpose(image)
+    image = image.convert("L")
+    image.thumbnail((OCR_IMAGE_MAX_SIDE, OCR_IMAGE_MAX_SIDE), PILImage.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=OCR_IMAGE_QUALITY, optimize=True)
+    if output.tell() >= len(data) and original_format in ("JPEG", "PNG"):
+        return data
+    return output.getvalue()
+
+
+_local_ocr_engine = None  # 每个工作进程各自加载一次本地OCR模型
+
+
+def _reading_order(result) -> str:
+    """把OCR识别出的文本框按阅读顺序拼接：同一行的按横坐标用空格连接，不同行换行"""
+    boxes = []
+    for box, text, _ in result:
+        ys = [point[1] for point in box]
+        boxes.append((min(ys), max(ys), min(point[0] for point in box), text))
+    boxes.sort()
+    lines = []
+    for top, bottom, left, text in boxes:
+        if lines:
+            line_top, line_bottom, items = lines[-1]
+            # 与上一行在垂直方向重叠超过一半时视为同一行
+            if min(bottom, line_bottom) - max(top, line_top) > (bottom - top) / 2:
+                items.append((left, text))
+                lines[-1] = (min(top, line_top), max(bottom, line_bottom), items)
+                continue
+        lines.append((top, bottom, [(left, text)]))
+    return "\n".join(" ".join(text for _, text in sorted(items)) for _, _, items in lines)
+
+
+def run_local_ocr(data: bytes) -> str:
+    """用本地ONNX OCR引擎识别图片中的文字（在进程池中执行）"""
+    global _local_ocr_engine
+    if _local_ocr_engine is None:
+        _local_ocr_engine = RapidOCR()
+    result, _ = _local_ocr_engine(prepare_ocr_image(data))
+    return _reading_order(result or []).strip()
+
+
+class OcrBackend(abc.ABC):
+    """OCR后端接口：recognize(图片URL, 图片内容, 截止时间)返回识别出的文字
+
+    图片内容可能为None（下载失败时），截止时间可能为None（不限制）。
+    """
+    name = ""
+
+    def available(self, image_data: bytes = None) -> bool:
+        return True
+
+    @abc.abstractmethod
+    async def recognize(self, image_url: str, image_data: bytes = None, deadline: "Deadline" = None) -> str:
+        """识别图片中的文字，失败时抛出异常"""
+
+
+class RemoteOcrBackend(OcrBackend):
+    """远程OCR接口（api.pearktrue.cn）"""
+    name = "远程接口"
+
+    def __init__(self, request):
+        self._request = request  # Main._ocr_request
+
+    async def recognize(self, image_url: str, image_data: bytes = None, deadline: "Deadline" = None) -> str:
+        return await self._request(image_url, image_data, deadline)
+
+
+class LocalOcrBackend(OcrBackend):
+    """基于rapidocr_onnxruntime的本地CPU OCR引擎，在专用进程池中运行，不依赖网络"""
+    name = "本地引擎"
+
+    def __init__(self, run_in_process, bulkhead: Bulkhead, latency: LatencyTracker):
+        self._run_in_process = run_in_process  # 在本地识别专用进程池中执行函数
+        self._bulkhead = bulkhead
+        self._latency = latency
+
+    def available(self, image_data: bytes = None) -> bool:
+        return RapidOCR is not None and image_data is not None
+
+    async def recognize(self, image_url: str, image_data: bytes = None, deadline: "Deadline" = None) -> str:
+        started = []
+        task = asyncio.ensure_future(self._run(image_data, started))
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not started:
+                # 还在排队，直接放弃
+                task.cancel()
+            else:
+                # 进程中的识别无法中途停止，让它在后台结束后再释放名额，避免进程池中堆积超过并发上限的识别
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            raise
+
+    async def _run(self, image_data: bytes, started: list) -> str:
+        async with self._bulkhead.acquire():
+            started.append(True)
+            start = time.monotonic()
+            text = await self._run_in_process(run_local_ocr, image_data)
+            self._latency.record(time.monotonic() - start)
+        return text
+
+
+class StreamingReply:
+    """把上游逐步返回的文本按段落分段发送给用户"""
+    BREAKS = "\n。！？!?"
+
+    def __init__(self, event: AstrMessageEvent, chunk_chars: int = STREAM_CHUNK_CHARS,
+                 flush_interval: float = STREAM_FLUSH_INTERVAL):
+        self.event = event
+        self.chunk_chars = chunk_chars
+        self.flush_interval = flush_interval
+        self.sent = 0  # 已发送的段数
+        self._buffer = ""
+        self._last_flush = time.monotonic()
+
+    async def feed(self, text: str):
+        self._buffer += text
+        due = time.monotonic() - self._last_flush >= self.flush_interval
+        if len(self._buffer) < self.chunk_chars and not (due and self._buffer.strip()):
+            return
+        # 尽量在换行或句末处分段，找不到合适位置且内容过长时直接切分
+        cut = max(self._buffer.rfind(ch) for ch in self.BREAKS) + 1
+        if cut < self.chunk_chars // 2:
+            if len(self._buffer) < self.chunk_chars * 2 and not due:
+                return
+            cut = len(self._buffer)
+        part, self._buffer = self._buffer[:cut], self._buffer[cut:]
+        if part.strip():
+            await self.event.send(self.event.plain_result(part.strip()))
+            self.sent += 1
+        self._last_flush = time.monotonic()
+
+    def pending(self) -> str:
+        """尚未发送的剩余文本"""
+        return self._buffer.strip()
+
+
+class RenderCache:
+    """渲染结果缓存：按HTML内容哈希寻址，内存层按字节数LRU淘汰，可选的磁盘层在插件重载后仍然有效"""
+    def __init__(self, directory: str, max_bytes: int, persistent: bool, disk_max_bytes: int,
+                 prune_interval: int = 1):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.persistent = persistent
+        self.disk_max_bytes = disk_max_bytes
+        self.prune_interval = prune_interval
+        self._writes_since_prune = prune_interval  # 加载后的第一次写入即检查上限
+        self._memory = OrderedDict()  # key -> 图片字节
+        self._page_counts = {}  # 多页图片的页数，单页图片不记录
+        self._bytes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.jpg")
+
+    def _page_keys(self, key: str, count: int) -> list:
+        return [key] + [f"{key}-{index}" for index in range(1, count)]
+
+    def _page_count(self, key: str) -> int:
+        count = self._page_counts.get(key)
+        if count is None and self.persistent:
+            try:
+                with open(os.path.join(self.directory, f"{key}.pages")) as f:
+                    count = int(f.read())
+            except (OSError, ValueError):
+                pass
+        return count or 1
+
+    def _load(self, key: str):
+        """查找单张图片，返回(本地路径, 是否来自内存)，未缓存时路径为None"""
+        path = self.path_for(key)
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            if not os.path.exists(path):
+                # 文件被清理时用内存中的数据恢复
+                self._write(path, data)
+            return path, True
+        if self.persistent and os.path.exists(path):
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+            self._remember(key, data)
+            return path, False
+        return None, False
+
+    def get(self, key: str):
+        """返回缓存图片各页的本地路径列表，任何一页缺失时视为未命中并返回None"""
+        paths = []
+        from_memory = True
+        for page_key in self._page_keys(key, self._page_count(key)):
+            path, in_memory = self._load(page_key)
+            if path is None:
+                self.misses += 1
+                return None
+            paths.append(path)
+            from_memory = from_memory and in_memory
+        if from_memory:
+            self.memory_hits += 1
+        else:
+            self.disk_hits += 1
+        return paths
+
+    def put(self, key: str, pages: list) -> list:
+        """写入渲染结果（每页一张图片），返回各页的本地路径列表"""
+        paths = []
+        for page_key, data in zip(self._page_keys(key, len(pages)), pages):
+            path = self.path_for(page_key)
+            self._write(path, data)
+            self._remember(page_key, data)
+            paths.append(path)
+        if len(pages) > 1:
+            self._page_counts[key] = len(pages)
+            if self.persistent:
+                self._write(os.path.join(self.directory, f"{key}.pages"), str(len(pages)).encode("ascii"))
+        if self.persistent:
+            self._maybe_prune_disk()
+        return paths
+
+    def close(self):
+        """不持久化时清理缓存目录中的图片"""
+        if self.persistent:
+            return
+        for key in list(self._memory):
+            self._discard_file(key)
+        self._memory.clear()
+        self._bytes = 0
+
+    def _write(self, path: str, data: bytes):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _remember(self, key: str, data: bytes):
+        if key in self._memory:
+            self._bytes -= len(self._memory.pop(key))
+        if len(data) > self.max_bytes:
+            return
+        self._memory[key] = data
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes:
+            old_key, old_data = self._memory.popitem(last=False)
+            self._bytes -= len(old_data)
+            self.evictions += 1
+            if not self.persistent:
+                self._discard_file(old_key)
+
+    def _discard_file(self, key: str):
+        try:
+            os.remove(self.path_for(key))
+        except OSError:
+            pass
+
+    def _maybe_prune_disk(self):
+        """每写入prune_interval次检查一次磁盘上限，避免每次写入都在事件循环中遍历缓存目录"""
+        self._writes_since_prune += 1
+        if self._writes_since_prune >= self.prune_interval:
+            self._writes_since_prune = 0
+            self._prune_disk()
+
+    def _prune_disk(self):
+        """磁盘缓存超出上限时按条目删除最久未使用的渲染结果（各页图片与页数文件一起删除）"""
+        entries = {}  # key -> [最近使用时间, 字节数, 文件路径列表]
+        total = 0
+        for name in os.listdir(self.directory):
+            stem, ext = os.path.splitext(name)
+            if ext not in (".jpg", ".pages"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            # 多页图片的后续页命名为 {key}-{序号}.jpg，与首页归为同一条目
+            entry = entries.setdefault(stem.partition("-")[0], [0.0, 0, []])
+            entry[0] = max(entry[0], stat.st_mtime)
+            entry[1] += stat.st_size
+            entry[2].append(path)
+            total += stat.st_size
+        if total <= self.disk_max_bytes:
+            return
+        for _, size, paths in sorted(entries.values()):
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+            if total <= self.disk_max_bytes:
+                break
+
+    def stats(self) -> dict:
+        total = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self._memory),
+            "bytes": self._bytes,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / total if total else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+class EncodeStats:
+    """统计渲染结果的编码效果：压缩前后的字节数、拆分页数和编码耗时"""
+    def __init__(self):
+        self.images = 0
+        self.pages = 0
+        self.original_bytes = 0
+        self.encoded_bytes = 0
+        self.seconds = 0.0
+        self.failures = 0
+
+    def record(self, original_bytes: int, encoded_bytes: int, pages: int, seconds: float):
+        self.images += 1
+        self.pages += pages
+        self.original_bytes += original_bytes
+        self.encoded_bytes += encoded_bytes
+        self.seconds += seconds
+
+    def stats(self) -> dict:
+        return {
+            "images": self.images,
+            "pages": self.pages,
+            "original_bytes": self.original_bytes,
+            "encoded_bytes": self.encoded_bytes,
+            "saved_bytes": self.original_bytes - self.encoded_bytes,
+            "avg_seconds": self.seconds / self.images if self.images else 0.0,
+            "failures": self.failures,
+        }
+
+
+class MessageDispatcher:
+    """按会话登记对后续消息感兴趣的处理函数
+
+    on_message监听所有消息，先按消息来源查表，没有登记的会话直接返回，
+    整个过滤过程只有一次字典查找，不创建任何对象。
+    """
+    def __init__(self):
+        self._routes = {}  # umo -> {sender_id: 处理函数}
+
+    def __len__(self) -> int:
+        return len(self._routes)
+
+    def register(self, umo: str, sender_id: str, handler):
+        senders = self._routes.get(umo)
+        if senders is None:
+            senders = self._routes[umo] = {}
+        senders[sender_id] = handler
+
+    def unregister(self, umo: str, sender_id: str):
+        senders = self._routes.get(umo)
+        if senders is not None:
+            senders.pop(sender_id, None)
+            if not senders:
+                del self._routes[umo]
+
+    def match(self, umo: str, sender_id: str):
+        """返回登记的处理函数，没有时返回None"""
+        senders = self._routes.get(umo)
+        if senders is None:
+            return None
+        return senders.get(sender_id)
+
+
+class WaitingSession:
+    """等待用户发送图片的会话记录，只保存会话标识和到期时间，不保存整个事件对象"""
+    __slots__ = ("umo", "sender_id", "expires_at")
+
+    def __init__(self, umo: str, sender_id: str, expires_at: float):
+        self.umo = umo  # 统一消息来源，用于超时后主动发送提示
+        self.sender_id = sender_id
+        self.expires_at = expires_at
+
+
+class WaitingSessions:
+    """等待发送图片的会话表，由单个协程批量清理过期会话
+
+    所有会话的等待时长相同，按插入顺序排列即按到期时间排列，
+    清理时只需从表头依次弹出，新增、查找、删除都是O(1)。
+    """
+    def __init__(self, timeout: float, max_sessions: int, sweep_interval: float, on_expired, on_removed=None):
+        self.timeout = timeout
+        self.max_sessions = max_sessions
+        self.sweep_interval = sweep_interval
+        self.on_expired = on_expired  # 异步回调：on_expired(过期的会话记录列表)
+        self.on_removed = on_removed  # 同步回调：会话因任何原因结束等待时调用on_removed(会话记录)
+        self._sessions = OrderedDict()  # (umo, sender_id) -> WaitingSession
+        self._task = None
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def add(self, umo: str, sender_id: str) -> WaitingSession:
+        """开始等待；同一会话重复开始时重新计时"""
+        key = (umo, sender_id)
+        self._remove(self._sessions.pop(key, None))
+        while len(self._sessions) >= self.max_sessions:
+            self._remove(self._sessions.popitem(last=False)[1])
+            self.evicted += 1
+        record = WaitingSession(umo, sender_id, time.monotonic() + self.timeout)
+        self._sessions[key] = record
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._sweep())
+        return record
+
+    def get(self, umo: str, sender_id: str):
+        """返回仍在等待的会话记录，不存在或已到期时返回None"""
+        record = self._sessions.get((umo, sender_id))
+        if record is None or record.expires_at <= time.monotonic():
+            return None
+        return record
+
+    def discard(self, umo: str, sender_id: str):
+        self._remove(self._sessions.pop((umo, sender_id), None))
+
+    def _remove(self, record):
+        if record is not None and self.on_removed is not None:
+            self.on_removed(record)
+
+    async def _sweep(self):
+        while self._sessions:
+            first = next(iter(self._sessions.values()))
+            # 等到表头到期后再多等一个合并间隔，让相近时间到期的会话一起处理
+            await asyncio.sleep(max(0.0, first.expires_at - time.monotonic()) + self.sweep_interval)
+            now = time.monotonic()
+            expired = []
+            while self._sessions:
+                record = next(iter(self._sessions.values()))
+                if record.expires_at > now:
+                    break
+                self._sessions.popitem(last=False)
+                self._remove(record)
+                expired.append(record)
+            if expired:
+                self.expired += len(expired)
+                try:
+                    await self.on_expired(expired)
+                except Exception as e:
+                    logger.error(f"处理过期会话出错: {str(e)}")
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        while self._sessions:
+            self._remove(self._sessions.popitem(last=False)[1])
+
+
+class RaceStats:
+    """记录“最快”指令中各模型的胜出次数和用时，用于调整参与竞速的模型"""
+    def __init__(self):
+        self.wins = {}  # 模型指令 -> [胜出次数, 累计用时]
+        self.failures = 0  # 所有模型都失败的次数
+
+    def record_win(self, command: str, elapsed: float):
+        entry = self.wins.setdefault(command, [0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed
+
+    def stats(self) -> dict:
+        """返回各模型的胜出次数和平均用时"""
+        return {command: (count, total / count) for command, (count, total) in self.wins.items()}
+
+
+@dataclass
+class SearchResult:
+    """一条搜索结果"""
+    title: str
+    snippet: str
+    url: str = ""
+    publish_time: str = ""
+    source: str = ""  # 返回该结果的搜索来源名称
+
+    def size(self) -> int:
+        """估算占用的字节数，用于缓存容量统计"""
+        return sum(len(text.encode("utf-8")) for text in (self.title, self.snippet, self.url, self.publish_time))
+
+
+def normalize_url(url: str) -> str:
+    """规范化URL用于去重：忽略协议、www前缀、末尾斜杠、锚点和跟踪参数"""
+    parts = urllib.parse.urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    query = "&".join(sorted(
+        param for param in parts.query.split("&")
+        if param and not param.lower().startswith(SEARCH_TRACKING_PARAMS)
+    ))
+    return f"{host}{parts.path.rstrip('/')}?{query}"
+
+
+def shingles(text: str, size: int = 3) -> set:
+    """把文本（去掉空白、忽略大小写）切分为长度为size的重叠片段集合"""
+    text = "".join(text.lower().split())
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def dedupe_results(results, threshold: float = SEARCH_DEDUPE_SIMILARITY) -> list:
+    """去掉重复的搜索结果：URL相同，或标题和片段高度相似（转载、镜像站）的只保留第一条"""
+    kept = []
+    seen_urls = set()
+    kept_shingles = []
+    for result in results:
+        url_key = normalize_url(result.url) if result.url else None
+        if url_key is not None and url_key in seen_urls:
+            continue
+        current = shingles(result.title + result.snippet)
+        if any(len(current & other) / len(current | other) >= threshold for other in kept_shingles):
+            continue
+        if url_key is not None:
+            seen_urls.add(url_key)
+        kept_shingles.append(current)
+        kept.append(result)
+    return kept
+
+
+def interleave(ranked_lists) -> list:
+    """轮流从各来源的结果列表中取结果，保留每个来源内部的排序"""
+    merged = []
+    for depth in range(max((len(results) for results in ranked_lists), default=0)):
+        merged.extend(results[depth] for results in ranked_lists if depth < len(results))
+    return merged
+
+
+SEARCH_TOKEN_PATTERN = re.compile(r"[a-z0-9]+|[一-鿿]")
+
+
+def search_terms(text: str) -> list:
+    """把文本切分为检索词：英文单词和数字整体作为一个词，中文取单字和相邻两字"""
+    tokens = SEARCH_TOKEN_PATTERN.findall(text.lower())
+    terms = list(tokens)
+    terms.extend(
+        first + second for first, second in zip(tokens, tokens[1:])
+        if len(first) == 1 and len(second) == 1 and first >= "一" and second >= "一"
+    )
+    return terms
+
+
+def bm25_rank(question: str, results: list, k1: float = SEARCH_BM25_K1, b: float = SEARCH_BM25_B) -> list:
+    """按与问题的BM25相关度对搜索结果重新排序（本地计算，不访问网络），得分相同时保持原顺序
+
+    只要有结果与问题相关，就去掉与问题没有任何共同检索词的结果。
+    """
+    query = set(search_terms(question))
+    if not query or not results:
+        return list(results)
+    documents = []
+    frequency = {}  # 检索词 -> 包含该词的结果数
+    for result in results:
+        counts = {}
+        for term in search_terms(f"{result.title} {result.snippet}"):
+            counts[term] = counts.get(term, 0) + 1
+        documents.append((counts, sum(counts.values())))
+        for term in query & counts.keys():
+            frequency[term] = frequency.get(term, 0) + 1
+    average_length = sum(length for _, length in documents) / len(documents) or 1
+    idf = {term: math.log(1 + (len(documents) - df + 0.5) / (df + 0.5)) for term, df in frequency.items()}
+    scores = []
+    for counts, length in documents:
+        norm = k1 * (1 - b + b * length / average_length)
+        scores.append(sum(
+            weight * counts[term] * (k1 + 1) / (counts[term] + norm)
+            for term, weight in idf.items() if term in counts
+        ))
+    order = sorted(range(len(results)), key=lambda i: -scores[i])
+    if scores[order[0]] > 0:
+        order = [i for i in order if scores[i] > 0]
+    return [results[i] for i in order]
+
+
+def build_search_context(results: list, budget: int = SEARCH_CONTEXT_BUDGET,
+                         max_results: int = SEARCH_MAX_RESULTS) -> str:
+    """按顺序把搜索结果整理为提供给大模型的文本，总长度不超过budget个字符，超出时截断最后一条的片段"""
+    blocks = []
+    remaining = budget
+    for result in results[:max_results]:
+        # 将ISO格式转换为YYYY-MM-DD格式
+        simple_time = result.publish_time.split("T")[0]
+        head = f"标题：{result.title}\n片段："
+        tail = f"\n发布日期：{simple_time}\n"
+        room = remaining - len(head) - len(tail)
+        if room < SEARCH_MIN_SNIPPET_CHARS and room < len(result.snippet):
+            break
+        snippet = result.snippet if len(result.snippet) <= room else result.snippet[:room - 1] + "…"
+        blocks.append(head + snippet + tail)
+        remaining -= len(blocks[-1])
+    return "".join(blocks)
+
+
+class SpeculationStats:
+    """记录联网模式推测执行的结果，用于评估节省的耗时和多出的上游请求"""
+    def __init__(self):
+        self.runs = 0  # 同时发起直接回答和联网回答的次数
+        self.skipped = 0  # 问题需要最新信息或推测关闭，只做联网回答的次数
+        self.direct_wins = 0
+        self.search_wins = 0
+        self.failures = 0
+        self.extra_requests = 0  # 结果未被采用的请求数（落选的直接回答，或被取消的联网回答）
+        self.saved_seconds = 0.0  # 直接回答胜出时，相比联网回答的中位耗时节省的时间
+        self.search_latency = LatencyTracker(min_samples=1)  # 联网回答的端到端耗时
+
+    def record_direct_win(self, elapsed: float, cancelled_search: bool):
+        self.direct_wins += 1
+        if cancelled_search:
+            self.extra_requests += 1
+        typical = self.search_latency.percentile(0.5)
+        if typical is not None:
+            self.saved_seconds += max(0.0, typical - elapsed)
+
+    def record_search_win(self):
+        self.search_wins += 1
+        self.extra_requests += 1
+
+
+class SearchFailedError(Exception):
+    """联网模式的所有搜索来源都返回了错误状态码"""
+    def __init__(self, status: int):
+        super().__init__(f"搜索引擎请求失败，服务器返回错误状态码：{status}")
+        self.status = status
+
+
+class DeadlineExceededError(asyncio.TimeoutError):
+    """请求的剩余时间不足以完成某个阶段"""
+    def __init__(self, stage: str):
+        super().__init__(f"{stage}超时")
+        self.stage = stage
+
+
+class Deadline:
+    """单个请求的截止时间：在指令入口创建并依次传给各个阶段，各阶段只能使用剩余的时间
+
+    run()执行一个阶段并记录耗时，超过剩余时间时取消该阶段；
+    请求超时时记录各阶段的耗时分布，便于定位是哪个阶段拖慢了请求。
+    """
+    def __init__(self, name: str, budget: float):
+        self.name = name
+        self.budget = budget
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + budget
+        self.stages = []  # [阶段名称, 开始时间（相对请求开始）, 耗时, 结果]
+        self._logged = False
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def timeout(self, cap: float = None, minimum: float = 0, reserve: float = 0) -> float:
+        """返回阶段可用的时间：剩余时间减去为后续阶段预留的时间，且不超过cap
+
+        可用时间不足minimum时直接抛出DeadlineExceededError，不再发起注定超时的请求。
+        """
+        available = self.remaining() - reserve
+        if available <= minimum:
+            raise DeadlineExceededError("剩余时间不足")
+        return available if cap is None else min(cap, available)
+
+    async def run(self, stage: str, awaitable, minimum: float = 0):
+        """在剩余时间内执行一个阶段，超时时取消并抛出DeadlineExceededError"""
+        record = [stage, time.monotonic() - self.started_at, 0.0, "完成"]
+        self.stages.append(record)
+        try:
+            if self.remaining() <= minimum:
+                if asyncio.iscoroutine(awaitable):
+                    awaitable.close()
+                raise DeadlineExceededError(stage)
+            return await asyncio.wait_for(awaitable, self.remaining())
+        except asyncio.CancelledError:
+            record[3] = "取消"
+            raise
         except Exception as e:
-            logger.error(f"请求腾讯元宝助手时发生错误：{e}")
-            return CommandResult().error(f"请求腾讯元宝助手时发生错误：{str(e)}")
+            # 阶段内部的请求按各自正常的超时时间执行，它们超时而请求还有剩余时间时属于阶段失败；
+            # 只有剩余时间耗尽或阶段因剩余时间不足放弃（DeadlineExceededError）才算请求超时
+            if not isinstance(e, DeadlineExceededError) and not (
+                    isinstance(e, asyncio.TimeoutError) and self.remaining() <= 0):
+                record[3] = "失败"
+                raise
+            record[2] = time.monotonic() - self.started_at - record[1]
+            record[3] = "超时"
+            self.log_timeout(stage)
+            if isinstance(e, DeadlineExceededError):
+                raise
+            raise DeadlineExceededError(stage) from e
+        finally:
+            record[2] = time.monotonic() - self.started_at - record[1]
+
+    def breakdown(self) -> str:
+        """各阶段的耗时分布"""
+        parts = [f"{stage}（{start:.1f}秒起）{elapsed:.2f}秒{result}" for stage, start, elapsed, result in self.stages]
+        used = time.monotonic() - self.started_at
+        return f"{'，'.join(parts) or '无'}；共用时{used:.1f}秒/预算{self.budget}秒"
+
+    def log_timeout(self, stage: str):
+        """记录一次超时的阶段耗时分布，同一请求只记录一次"""
+        if self._logged:
+            return
+        self._logged = True
+        logger.warning(f"{self.name}在{stage}阶段超时：{self.breakdown()}")
+
+
+class ImageTooLargeError(Exception):
+    """图片超过允许下载的大小"""
+    def __init__(self, limit: int):
+        super().__init__(f"图片超过{limit // (1024 * 1024)}MB，无法处理")
+        self.limit = limit
+
+
+class UnsupportedImageError(Exception):
+    """下载的内容不是支持的图片格式"""
+    def __init__(self):
+        super().__init__("不是支持的图片格式（支持JPEG、PNG、GIF、WEBP、BMP）")
+
+
+class OcrError(Exception):
+    """OCR接口拒绝了请求或返回了无法使用的结果"""
+
+
+class SolverError(Exception):
+    """解题助手返回了无法使用的结果，异常信息可直接展示给用户"""
+
+
+class ImageSolveError(Exception):
+    """图片解题的某一步失败，异常信息可直接展示给用户"""
+
+
+class SingleFlight:
+    """合并相同的并发请求：同一时刻相同键的请求只向上游发起一次，结果或异常由所有等待者共享"""
+    def __init__(self):
+        self._calls = {}  # key -> [共享任务, 等待者数量]
+        self.started = 0  # 实际发起的请求数
+        self.coalesced = 0  # 被合并的请求数
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key, factory):
+        call = self._calls.get(key)
+        if call is None:
+            task = asyncio.ensure_future(factory())
+            call = [task, 0]
+            self._calls[key] = call
+            task.add_done_callback(lambda t: self._finish(key, call))
+            self.started += 1
+        else:
+            self.coalesced += 1
+        
+        task = call[0]
+        call[1] += 1
+        try:
+            # shield保证单个等待者被取消时不会影响其他等待者
+            return await asyncio.shield(task)
+        finally:
+            call[1] -= 1
+            if call[1] == 0 and not task.done():
+                # 所有等待者都已离开，取消上游请求以释放连接；
+                # 同时立即移除该键，避免新的请求在取消完成前加入这个正在取消的任务
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+                task.cancel()
+
+    def _finish(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        task = call[0]
+        if not task.cancelled():
+            # 标记异常已被读取，避免无人等待时输出警告
+            task.exception()
+
+
+def flight_key(data: dict = None):
+    """把请求参数转换为可哈希的键"""
+    if not data:
+        return None
+    return json.dumps(data, sort_keys=True, ensure_ascii=False)
+
+
+class TTLCache:
+    """带过期时间的LRU缓存，同时按条目数和字节数限制容量"""
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()  # key -> (过期时间, 字节数, 值)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key):
+        """读取缓存，过期或不存在时返回None"""
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, _, value = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key):
+        """读取缓存但不计入命中统计、不调整淘汰顺序，过期或不存在时返回None"""
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[2]
+
+    def set(self, key, value, ttl: float, size: int = None):
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        if size is None:
+            size = len(value.encode("utf-8")) if isinstance(value, str) else len(value)
+        if ttl <= 0 or size > self.max_bytes:
+            return
+        if key in self._data:
+            self._remove(key)
+        self._data[key] = (time.monotonic() + ttl, size, value)
+        self._bytes += size
+        while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._data)))
+            self.evictions += 1
+
+    def clear(self):
+        self._data.clear()
+        self._bytes = 0
+
+    def _remove(self, key):
+        _, size, _ = self._data.pop(key)
+        self._bytes -= size
+
+    def stats(self) -> dict:
+        """返回缓存命中统计"""
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class OcrCache:
+    """OCR结果缓存：按图片内容的SHA-256寻址，内存层为TTLCache，可选的磁盘层在插件重载后仍然有效
+
+    每条结果同时记录当初识别的耗时，命中时累计为节省的上游耗时。
+    """
+    def __init__(self, directory: str, max_entries: int, max_bytes: int, ttl: float,
+                 persistent: bool, disk_max_entries: int, prune_interval: int = 1):
+        self.directory = directory
+        self.ttl = ttl
+        self.persistent = persistent
+        self.disk_max_entries = disk_max_entries
+        self.prune_interval = prune_interval
+        self._writes_since_prune = prune_interval  # 加载后的第一次写入即检查上限
+        self._memory = TTLCache(max_entries, max_bytes)  # 摘要 -> (识别结果, 识别耗时)
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        if persistent:
+            os.makedirs(directory, exist_ok=True)
+
+    def path_for(self, digest: str) -> str:
+        return os.path.join(self.directory, f"{digest}.json")
+
+    def get(self, digest: str):
+        """返回缓存的识别结果，未命中或已过期时返回None"""
+        entry = self._memory.get(digest)
+        if entry is not None:
+            self.memory_hits += 1
+        elif self.persistent:
+            entry = self._read_disk(digest)
+            if entry is not None:
+                self.disk_hits += 1
+        if entry is None:
+            self.misses += 1
+            return None
+        text, seconds = entry
+        self.saved_seconds += seconds
+        return text
+
+    def set(self, digest: str, text: str, seconds: float):
+        """写入识别结果及其耗时"""
+        self._memory.set(digest, (text, seconds), self.ttl, size=len(text.encode("utf-8")))
+        if not self.persistent:
+            return
+        path = self.path_for(digest)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"text": text, "seconds": seconds}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+            self._maybe_prune_disk()
+        except OSError as e:
+            logger.warning(f"写入OCR缓存失败：{e}")
+
+    def _read_disk(self, digest: str):
+        path = self.path_for(digest)
+        try:
+            age = time.time() - os.path.getmtime(path)
+            if age >= self.ttl:
+                os.remove(path)
+                return None
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        entry = (data.get("text", ""), data.get("seconds", 0.0))
+        # 读入内存层，剩余有效期与磁盘文件一致
+        self._memory.set(digest, entry, self.ttl - age, size=len(entry[0].encode("utf-8")))
+        return entry
+
+    def _maybe_prune_disk(self):
+        """每写入prune_interval次检查一次磁盘上限，避免每次写入都在事件循环中列出整个缓存目录"""
+        self._writes_since_prune += 1
+        if self._writes_since_prune >= self.prune_interval:
+            self._writes_since_prune = 0
+            self._prune_disk()
+
+    def _prune_disk(self):
+        """磁盘缓存超出条目上限时删除最早写入的结果"""
+        names = [name for name in os.listdir(self.directory) if name.endswith(".json")]
+        if len(names) <= self.disk_max_entries:
+            return
+        entries = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                continue
+        for _, path in sorted(entries)[:len(entries) - self.disk_max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        hits = self.memory_hits + self.disk_hits
+        total = hits + self.misses
+        return {
+            "entries": len(self._memory),
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": hits / total if total else 0.0,
+            "saved_seconds": self.saved_seconds,
+        }
+
+
+def split_solver_answer(answer: str):
+    """从解题助手的answer中提取思考过程和答案
+
+    answer格式：<Think>思考内容</Think>【解题答案：答案内容】
+    """
+    think_start = answer.find("<Think>")
+    think_end = answer.find("</Think>")
+    if think_start != -1 and think_end != -1:
+        thinking = answer[think_start + len("<Think>"):think_end].strip()
+        answer_content = answer[think_end + len("</Think>"):].strip()
+        # 移除可能的【解题答案：】前缀
+        if answer_content.startswith("【解题答案："):
+            answer_content = answer_content[len("【解题答案："):].strip()
+            if answer_content.endswith("】"):
+                answer_content = answer_content[:-1].strip()
+    else:
+        # 如果没有<Think>标签，直接使用answer作为答案
+        thinking = ""  # 没有思考过程
+        answer_content = answer.strip()
+    return thinking, answer_content
+
+
+def solver_error_message(error: Exception):
+    """把解题助手请求的异常转换为展示给用户的提示，未知异常返回None"""
+    if isinstance(error, UpstreamStatusError):
+        return f"解题助手请求失败，服务器返回错误状态码：{error.status}"
+    if isinstance(error, SolverError):
+        return str(error)
+    if isinstance(error, BulkheadFullError):
+        return BUSY_MESSAGE
+    if isinstance(error, CircuitOpenError):
+        return f"解题助手{error}"
+    if isinstance(error, asyncio.TimeoutError):
+        return "解题助手请求超时，服务器响应过慢\n\n建议：\n1. 检查网络连接\n2. 稍后重试"
+    if isinstance(error, aiohttp.ClientError):
+        return f"解题助手网络请求失败：{str(error)}\n\n建议：\n1. 检查网络连接\n2. 稍后重试"
+    return None
+
+
+FILE_URL_PATTERN = re.compile(r"https?://[^\s\`\']+")  # 微信格式file字段中的图片URL
+
+
+def image_url_of(component) -> str:
+    """从图片组件中取出URL，兼容url字段和微信格式的file字段"""
+    if hasattr(component, "url") and component.url:
+        return component.url.strip()
+    if hasattr(component, "file") and component.file:
+        # 从file字段提取URL - 处理微信格式
+        file_content = str(component.file)
+        if "http" in file_content:
+            # 提取URL并移除反引号
+            match = FILE_URL_PATTERN.search(file_content)
+            if match:
+                return match.group().strip("`'")
+    return None
+
+
+def format_solution(question: str, thinking: str, answer: str, created_at: str) -> str:
+    """把解题结果整理成用于生成图片的文本"""
+    return f"题目：\n{question}\n\n思考过程：\n{thinking}\n\n答案：\n{answer}\n\n时间：\n{created_at}"
+
+
+def parse_card_blocks(text: str) -> list:
+    """把菜单样式的文本解析为卡片结构，HTML渲染和本地渲染共用
+
+    返回的每一项为：
+    ("category", 分类名)、("model", 模型名, 指令格式, 示例, 描述) 或 ("line", 文本)
+    """
+    blocks = []
+    for line in text.split('\n'):
+        line = line.rstrip()
+        
+        # 大模型菜单标题已在模板中处理，空行直接跳过
+        if line == "大模型菜单" or line.strip() == '':
+            continue
+        
+        # 检测分类标题
+        if line.startswith(('一、', '二、', '三、', '四、')):
+            blocks.append(("category", line.split('、')[1]))
+        
+        # 检测模型条目
+        elif ' - ' in line:
+            model_part, desc_part = line.split(' - ', 1)
+            
+            # 只有包含示例格式的才是模型命令，其余带“ - ”的行不显示
+            if '<提问内容>' in model_part or '<6位数字>' in model_part or '<图片>' in model_part or '<题目内容>' in model_part:
+                model_format = model_part.strip()
+                model_name = model_format.split(' ')[0]
+                example = model_format.replace('<提问内容>', '1+1').replace('<6位数字>', '123456').replace('<图片>', '[图片]').replace('<题目内容>', '1+1')
+                blocks.append(("model", model_name, model_format, example, desc_part.strip()))
+        
+        else:
+            blocks.append(("line", line))
+    return blocks
+
+
+def find_font(candidates) -> str:
+    """返回候选列表中第一个存在的字体文件"""
+    for path in candidates:
+        if path and os.path.exists(path):
+            return path
+    return None
+
+
+@functools.lru_cache(maxsize=32)
+def _load_font(path: str, size: int):
+    return ImageFont.truetype(path, size)
+
+
+@functools.lru_cache(maxsize=65536)
+def _glyph_width(path: str, size: int, char: str) -> float:
+    """单个字符的宽度，按（字体，字号，字符）缓存"""
+    return _load_font(path, size).getlength(char)
+
+
+def _layout_runs(runs, max_width: float) -> list:
+    """把带样式的文本片段按最大宽度自动换行
+
+    runs中每一项为 (文本, 字体路径, 字号, 颜色, 粗体, 左右外边距)，返回按行分组的 (x, 文本, 字体路径, 字号, 颜色, 粗体)。
+    """
+    lines = [[]]
+    x = 0.0
+    for text, path, size, color, bold, margin in runs:
+        x += margin
+        piece = ""
+        piece_x = x
+        for char in text:
+            width = _glyph_width(path, size, char)
+            if x + width > max_width and x > 0:
+                if piece:
+                    lines[-1].append((piece_x, piece, path, size, color, bold))
+                lines.append([])
+                piece = ""
+                x = 0.0
+                piece_x = 0.0
+                if char == " ":
+                    continue
+            piece += char
+            x += width
+        if piece:
+            lines[-1].append((piece_x, piece, path, size, color, bold))
+        x += margin
+    return lines
+
+
+def render_card_image(blocks: list, font_path: str, bold_font_path: str = None, quality: int = 95) -> bytes:
+    """不经过浏览器，按MENU_TEMPLATE的样式把卡片结构直接绘制为JPEG图片（可在进程池中执行）"""
+    bold_path = bold_font_path or font_path
+    fake_bold = bold_font_path is None  # 没有粗体字体时用描边模拟粗体
+    content_width = 950
+    padding = 40
+    page_margin = 20
+    width = content_width + padding * 2 + page_margin * 2
+    
+    # 第一遍：计算布局，记录绘制操作
+    ops = []
+    y = page_margin + padding
+    
+    # 菜单标题
+    title_font = _load_font(bold_path, 32)
+    ops.append(("rect", (page_margin + padding, y, page_margin + padding + content_width, y + 94), "#e8f5e8", 8))
+    title_width = title_font.getlength("大模型菜单")
+    ops.append(("text", page_margin + padding + (content_width - title_width) / 2, y + 47, "大模型菜单", bold_path, 32, "#28a745", True))
+    y += 94 + 40
+    
+    for block in blocks:
+        kind = block[0]
+        if kind == "category":
+            y += 30
+            lines = _layout_runs([(block[1], bold_path, 24, "#17a2b8", True, 0)], content_width)
+            for line in lines:
+                for x, text, path, size, color, bold in line:
+                    ops.append(("text", page_margin + padding + x, y + 10 + 24, text, path, size, color, bold))
+                y += 48
+            y += 20
+            ops.append(("rect", (page_margin + padding, y, page_margin + padding + content_width, y + 3), "#17a2b8", 0))
+            y += 3 + 20
+        elif kind == "model":
+            _, model_name, model_format, example, model_desc = block
+            runs = [
+                (model_name + " ", bold_path, 20, "#dc3545", True, 0),
+                (model_format + " ", font_path, 18, "#333333", False, 0),
+                ("---------------", font_path, 18, "#adb5bd", False, 10),
+                (f"示例：{example}（注意有空格）", font_path, 18, "#6c757d", False, 10),
+                ("----------", font_path, 18, "#adb5bd", False, 10),
+                (model_desc, bold_path, 18, "#495057", True, 0),
+            ]
+            inner_left = page_margin + padding + 4 + 10
+            lines = _layout_runs(runs, content_width - 4 - 20)
+            line_height = 40
+            box_height = len(lines) * line_height + 20
+            y += 15
+            ops.append(("rect", (page_margin + padding, y, page_margin + padding + content_width, y + box_height), "#f8f9fa", 8))
+            ops.append(("rect", (page_margin + padding, y, page_margin + padding + 4, y + box_height), "#ffc107", 0))
+            for index, line in enumerate(lines):
+                for x, text, path, size, color, bold in line:
+                    ops.append(("text", inner_left + x, y + 10 + index * line_height + line_height / 2, text, path, size, color, bold))
+            y += box_height + 15
+        else:
+            lines = _layout_runs([(block[1], font_path, 16, "#000000", False, 0)], content_width)
+            for line in lines:
+                for x, text, path, size, color, bold in line:
+                    ops.append(("text", page_margin + padding + x, y + 16, text, path, size, color, bold))
+                y += 32
+    
+    height = y + padding + page_margin
+    
+    # 第二遍：绘制
+    image = PILImage.new("RGB", (width, height), "#f5f5f5")
+    draw = ImageDraw.Draw(image)
+    draw.rounded_rectangle(
+        (page_margin, page_margin, width - page_margin, height - page_margin), radius=12, fill="#ffffff", outline="#e6e6e6"
+    )
+    for op in ops:
+        if op[0] == "rect":
+            _, box, fill, radius = op
+            if radius:
+                draw.rounded_rectangle(box, radius=radius, fill=fill)
+            else:
+                draw.rectangle(box, fill=fill)
+        else:
+            _, x, center_y, text, path, size, color, bold = op
+            stroke = 1 if bold and fake_bold else 0
+            draw.text((x, center_y), text, font=_load_font(path, size), fill=color, anchor="lm",
+                      stroke_width=stroke, stroke_fill=color)
+    
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=quality)
+    return output.getvalue()
+
+
+def encoding_signature() -> str:
+    """图片编码参数，作为渲染缓存键的一部分，修改编码配置后旧的缓存自动失效"""
+    return flight_key({
+        "budget": IMAGE_BYTE_BUDGET,
+        "max_height": IMAGE_MAX_PAGE_HEIGHT,
+        "qualities": IMAGE_QUALITY_STEPS,
+        "min_width": IMAGE_MIN_WIDTH,
+    })
+
+
+def _find_page_break(gray, bottom: int, search: int) -> int:
+    """在bottom向上search像素内寻找没有深色文字的像素行作为分页位置，避免把一行文字切开"""
+    for y in range(bottom, max(bottom - search, 1), -1):
+        low, _ = gray.crop((0, y - 1, gray.width, y)).getextrema()
+        if low > 160:
+            return y
+    return bottom
+
+
+def _encode_jpeg(image, quality: int) -> bytes:
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return output.getvalue()
+
+
+def _encode_page(image) -> bytes:
+    """二分查找不超过字节预算的最高JPEG质量；最低质量仍超出时按比例缩小图片后重试"""
+    while True:
+        best = None
+        low, high = 0, len(IMAGE_QUALITY_STEPS) - 1
+        smallest = None
+        while low <= high:
+            middle = (low + high) // 2
+            data = _encode_jpeg(image, IMAGE_QUALITY_STEPS[middle])
+            if len(data) <= IMAGE_BYTE_BUDGET:
+                best = data
+                high = middle - 1
+            else:
+                smallest = data
+                low = middle + 1
+        if best is not None:
+            return best
+        if image.width <= IMAGE_MIN_WIDTH:
+            # 已是最低质量和最小宽度，返回能得到的最小结果
+            return smallest
+        # 字节数大致与面积成正比，据此估算缩放比例
+        scale = max((IMAGE_BYTE_BUDGET / len(smallest)) ** 0.5 * 0.95, IMAGE_MIN_WIDTH / image.width)
+        image = image.resize((int(image.width * scale), max(int(image.height * scale), 1)), PILImage.LANCZOS)
+
+
+def encode_image(data: bytes) -> list:
+    """把渲染得到的图片编码为不超过字节预算的JPEG，过高的页面拆分为多页（在线程中执行）
+
+    未超出预算且高度合适的图片原样返回，避免重复有损编码。
+    """
+    if PILImage is None:
+        return [data]
+    image = PILImage.open(io.BytesIO(data))
+    if len(data) <= IMAGE_BYTE_BUDGET and image.height <= IMAGE_MAX_PAGE_HEIGHT:
+        return [data]
+    image = image.convert("RGB")
+    
+    # 按最大高度均分页面，分页位置向上对齐到文字行之间的空白处
+    count = -(-image.height // IMAGE_MAX_PAGE_HEIGHT)
+    page_height = -(-image.height // count)
+    gray = image.convert("L") if count > 1 else None
+    breaks = [_find_page_break(gray, index * page_height, page_height // 4) for index in range(1, count)]
+    pages = []
+    top = 0
+    for bottom in breaks + [image.height]:
+        pages.append(_encode_page(image.crop((0, top, image.width, bottom))))
+        top = bottom
+    return pages
+
+
+def image_reply(event: AstrMessageEvent, image_urls: list):
+    """单张图片直接发送，拆分后的多页图片合并为一条消息发送"""
+    if len(image_urls) == 1:
+        return event.image_result(image_urls[0])
+    return event.chain_result([MsgImage.fromFileSystem(path) for path in image_urls])
+
+
+def pipeline_queue_notifier(event: AstrMessageEvent):
+    """生成解题流水线排队时通知用户的回调，同一请求只通知一次"""
+    notified = False
+    
+    async def notify(stage_name: str, position: int):
+        nonlocal notified
+        if notified:
+            return
+        notified = True
+        await event.send(event.plain_result(f"当前解题任务较多，正在排队（{stage_name}第{position}位），请稍候..."))
+    return notify
+
+
+def image_available(image_url: str) -> bool:
+    """判断渲染得到的图片是否仍然可用（本地文件可能已被清理）"""
+    if not image_url:
+        return False
+    if image_url.startswith(("http://", "https://")):
+        return True
+    path = image_url[len("file://"):] if image_url.startswith("file://") else image_url
+    return os.path.exists(path)
+
+
+def normalize_question(question: str) -> str:
+    """规范化提问内容（合并空白、忽略大小写），用作缓存键"""
+    return " ".join(question.split()).lower()
+
+
+def build_model_menu() -> str:
+    """根据大模型注册表生成大模型菜单文本"""
+    menu_content = "大模型菜单\n\n"
+    
+    # 1. 单次问答模型
+    menu_content += "一、单次问答模型\n"
+    for spec in MODEL_REGISTRY:
+        if not spec.needs_uid:
+            menu_content += f"{spec.command} <提问内容> - {spec.title}\n"
+    menu_content += "最快 <提问内容> - 同时询问多个模型，返回最先完成的回答\n"
+    menu_content += "\n"
+    
+    # 2. 记忆模型
+    menu_content += "二、记忆模型\n"
+    for spec in MODEL_REGISTRY:
+        if spec.needs_uid:
+            menu_content += f"{spec.command} <6位数字> <提问内容> - {spec.title}\n"
+    menu_content += "\n"
+    
+    # 3. 联网模式
+    menu_content += "三、联网模式\n"
+    menu_content += "联网模式 <提问内容> - 结合搜索引擎和DeepSeek-3.2AI进行问答\n"
+    menu_content += "\n"
+    
+    # 4. 解题模型
+    menu_content += "四、解题模型\n"
+    menu_content += "解题助手 <题目内容> - 调用万能解题助手，返回图片结果\n"
+    menu_content += "图片解题助手 <图片> - 识别图片中的题目并解题，返回图片结果\n"
+    return menu_content
+
+
+@register("D-G-N-C-J", "Tinyxi", "腾讯元宝+DeepSeek-3.2+DeepSeek-3.1+GPT5-nano+Claude4.5-hiku+Qwen3-coder+DeepSeek-R1+智谱GLM4.6+夸克AI+蚂蚁AI+豆包AI+ChatGPT-oss+谷歌Gemini-2.5+阿里AI+讯飞AI", "1.0.0", "")
+class Main(Star):
+    def __init__(self, context: Context) -> None:
+        super().__init__(context)
+        # 按会话登记需要接收后续消息的处理函数，on_message据此快速过滤
+        self.dispatcher = MessageDispatcher()
+        # 存储等待图片的会话，到期后由单个协程批量发送超时提示，结束等待时取消登记
+        self.waiting_sessions = WaitingSessions(
+            WAITING_TIMEOUT, WAITING_MAX_SESSIONS, WAITING_SWEEP_INTERVAL, self._on_waiting_expired,
+            lambda record: self.dispatcher.unregister(record.umo, record.sender_id),
+        )
+        self._sessions = {}  # 按主机缓存的HTTP会话，首次使用时创建
+        self._bulkheads = {}  # 按接口和主机划分的隔离舱
+        self._breakers = {}  # 按接口划分的熔断器
+        self._latencies = {}  # 按接口统计的请求耗时
+        self.race_stats = RaceStats()  # “最快”指令的胜出统计
+        self._request_stats = {"retries": 0, "hedges": 0, "hedge_wins": 0}  # 重试与对冲请求计数
+        # 渲染结果缓存，相同内容的图片不再重复渲染
+        self.render_cache = RenderCache(
+            os.path.join(PLUGIN_DATA_DIR, "render_cache"),
+            RENDER_CACHE_MAX_BYTES,
+            RENDER_CACHE_DISK,
+            RENDER_CACHE_DISK_MAX_BYTES,
+            RENDER_CACHE_PRUNE_INTERVAL,
+        )
+        # 菜单渲染调度：解题结果的图片生成由流水线的图片生成阶段限制并发，这里只限制菜单图片的渲染
+        self._render_slots = Bulkhead("页面渲染", RENDER_WORKERS, RENDER_MAX_QUEUE, RENDER_QUEUE_TIMEOUT)
+        self._render_latency = LatencyTracker(min_samples=1)
+        # 本地绘制：不经过浏览器，用Pillow直接把卡片绘制为图片
+        self._local_fonts = (None, None)
+        if PILImage is not None and RENDER_ENGINE != "html":
+            self._local_fonts = (find_font(LOCAL_RENDER_FONTS), find_font(LOCAL_RENDER_BOLD_FONTS))
+        self._process_pools = {}  # 进程池名称 -> CPU密集任务的进程池，首次使用时创建
+        self._local_render_latency = LatencyTracker(min_samples=1)
+        self.encode_stats = EncodeStats()  # 渲染结果的自适应编码统计
+        self._menu_image = None  # 已渲染的大模型菜单图片：(内容哈希, 各页图片路径)
+        self._menu_lock = asyncio.Lock()
+        self._warm_up_task = None
+        try:
+            self._warm_up_task = asyncio.get_running_loop().create_task(self._warm_up_menu())
+        except RuntimeError:
+            # 没有运行中的事件循环时，改为首次使用时渲染
+            pass
+        self._flights = SingleFlight()  # 合并相同的并发上游请求
+        self.answer_cache = TTLCache(ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_MAX_BYTES)  # 单次问答模型的回答缓存
+        self.search_cache = TTLCache(SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_MAX_BYTES)  # 联网模式的搜索结果缓存
+        # 各搜索来源的统计：来源名称 -> [成功次数, 失败次数, 超时次数, 返回结果总数]
+        self.search_stats = {backend.name: [0, 0, 0, 0] for backend in SEARCH_BACKENDS if backend.enabled}
+        self._search_latency = {}  # 搜索信息字符数分组 -> 联网回答耗时
+        self.speculation_stats = SpeculationStats()  # 联网模式推测执行统计
+        # OCR结果缓存，按图片内容寻址，同一张图片重复发送时不再调用OCR接口
+        self.ocr_cache = OcrCache(
+            os.path.join(PLUGIN_DATA_DIR, "ocr_cache"),
+            OCR_CACHE_MAX_ENTRIES,
+            OCR_CACHE_MAX_BYTES,
+            OCR_CACHE_TTL,
+            OCR_CACHE_DISK,
+            OCR_CACHE_DISK_MAX_ENTRIES,
+            OCR_CACHE_PRUNE_INTERVAL,
+        )
+        self._ocr_accepts_bytes = True  # OCR接口是否接受base64图片内容，失败后改为发送URL
+        # 按发送方式统计OCR端到端耗时（含图片预处理），用于比较上传图片与发送URL
+        self._ocr_latency = {
+            "上传图片": LatencyTracker(min_samples=1),
+            "图片链接": LatencyTracker(min_samples=1),
+            "本地引擎": LatencyTracker(min_samples=1),
+        }
+        # OCR后端：远程接口和本地引擎，由_select_ocr_backends按策略选择
+        self._ocr_backend_wins = {}  # 后端名称 -> 成功识别次数
+        # 解题流水线：下载、识别、解题、图片生成各阶段有独立的工作协程和有界队列
+        handlers = {
+            "fetch": lambda job: self._prefetch_image(*job),
+            "ocr": lambda job: self._recognize_image(*job),
+            "solve": lambda job: self._call_solver(*job),
+            "render": lambda job: self.text_to_image_menu_style(*job),
+        }
+        self._pipeline = {
+            stage: PipelineStage(name, handlers[stage], workers, max_queue)
+            for stage, (name, workers, max_queue) in PIPELINE_STAGES.items()
+        }
+        self._jobs_in_flight = 0  # 正在处理的解题请求数
+        self.remote_ocr = RemoteOcrBackend(self._ocr_request)
+        self.local_ocr = LocalOcrBackend(
+            functools.partial(self._run_in_process, pool="ocr"),
+            Bulkhead("本地OCR", OCR_LOCAL_CONCURRENCY, OCR_LOCAL_MAX_QUEUE, BULKHEAD_MAX_WAIT),
+            self._ocr_latency["本地引擎"],
+        )
+
+    def _get_session(self, url: str) -> aiohttp.ClientSession:
+        """获取目标主机的共享HTTP会话，复用TCP/TLS连接"""
+        host = urllib.parse.urlsplit(url).netloc
+        session = self._sessions.get(host)
+        if session is None or session.closed:
+            # 连接数不少于主机隔离舱的并发上限，否则隔离舱放行的请求会在连接池中排队，
+            # 既消耗请求的超时时间，也不计入隔离舱的排队统计
+            per_host = max(HTTP_POOL_LIMIT_PER_HOST, HOST_BULKHEADS.get(host, DEFAULT_HOST_BULKHEAD)[0])
+            connector = aiohttp.TCPConnector(
+                limit=max(HTTP_POOL_LIMIT, per_host),
+                limit_per_host=per_host,
+                ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+                keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            )
+            session = aiohttp.ClientSession(connector=connector)
+            self._sessions[host] = session
+        return session
+
+    @filter.command("腾讯元宝")
+    async def tencent_yuanbao(self, message: AstrMessageEvent):
+        """腾讯元宝助手，支持异步请求"""
+        return await self._ask_model("腾讯元宝", message)
 
     @filter.command("deep3.2")
     async def deepseek_32(self, message: AstrMessageEvent):
         """DeepSeek-3.2助手，支持异步请求"""
-        msg = message.message_str.replace("deep3.2", "").strip()
-        
-        if not msg:
-            return CommandResult().error("正确指令：deep3.2 <提问内容>\n\n示例：deep3.2 1+1")
-        
-        question = msg.strip()
-        
-        # 添加提示词
-        prompt = f"{question}\n\n注意：这是回答QQ平台的问题，请注意违禁词，避免涉政，涉黄，暴力，血腥，反人类，反人伦。"
-        
-        api_url = "https://api.jkyai.top/API/depsek3.2.php"
-        params = {
-            "question": prompt
-        }
-        
-        try:
-            timeout = aiohttp.ClientTimeout(total=60)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(api_url, params=params) as resp:
-                    if resp.status != 200:
-                        return CommandResult().error("请求DeepSeek-3.2助手失败，服务器返回错误状态码")
-                    
-                    result = await resp.text()
-                    
-                    return CommandResult().message(result)
-                        
-        except aiohttp.ClientError as e:
-            logger.error(f"网络连接错误：{e}")
-            return CommandResult().error("无法连接到DeepSeek-3.2助手服务器，请稍后重试或检查网络连接")
-        except asyncio.TimeoutError:
-            logger.error("请求超时")
-            return CommandResult().error("请求超时，请稍后重试")
-        except Exception as e:
-            logger.error(f"请求DeepSeek-3.2助手时发生错误：{e}")
-            return CommandResult().error(f"请求DeepSeek-3.2助手时发生错误：{str(e)}")
+        return await self._ask_model("deep3.2", message)
 
     @filter.command("deep3.1")
     async def deepseek_31(self, message: AstrMessageEvent):
         """DeepSeek-3.1助手，支持异步请求"""
-        msg = message.message_str.replace("deep3.1", "").strip()
-        
-        if not msg:
-            return CommandResult().error("正确指令：deep3.1 <提问内容>\n\n示例：deep3.1 1+1")
-        
-        question = msg.strip()
-        
-        # 添加提示词
-        prompt = f"{question}\n\n注意：这是回答QQ平台的问题，请注意违禁词，避免涉政，涉黄，暴力，血腥，反人类，反人伦。"
-        
-        api_url = "https://api.jkyai.top/API/depsek3.1.php"
-        params = {
-            "question": prompt
-        }
-        
-        try:
-            timeout = aiohttp.ClientTimeout(total=60)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(api_url, params=params) as resp:
-                    if resp.status != 200:
-                        return CommandResult().error("请求DeepSeek-3.1助手失败，服务器返回错误状态码")
-                    
-                    result = await resp.text()
-                    
-                    return CommandResult().message(result)
-                        
-        except aiohttp.ClientError as e:
-            logger.error(f"网络连接错误：{e}")
-            return CommandResult().error("无法连接到DeepSeek-3.1助手服务器，请稍后重试或检查网络连接")
-        except asyncio.TimeoutError:
-            logger.error("请求超时")
-            return CommandResult().error("请求超时，请稍后重试")
-        except Exception as e:
-            logger.error(f"请求DeepSeek-3.1助手时发生错误：{e}")
-            return CommandResult().error(f"请求DeepSeek-3.1助手时发生错误：{str(e)}")
+        return await self._ask_model("deep3.1", message)
 
     @filter.command("gpt5")
     async def gpt5_nano(self, message: AstrMessageEvent):
         """GPT5-nano助手，支持记忆功能"""
-        msg = message.message_str.replace("gpt5", "").strip()
-        
-        if not msg:
-            return CommandResult().error("正确指令：gpt5 <记忆数> <提问内容>\n\n示例：gpt5 123456 你好")
-        
-        # 分割输入，提取记忆数和问题
-        parts = msg.split(" ", 1)
-        if len(parts) != 2:
-            return CommandResult().error("正确格式：gpt5 <记忆数> <提问内容>\n\n示例：gpt5 123456 你好")
-        
-        uid = parts[0].strip()
-        question = parts[1].strip()
-        
-        # 验证记忆数是否为6位数字
-        if not uid.isdigit() or len(uid) != 6:
-            return CommandResult().error("记忆数必须是6位数字\n\n正确格式：gpt5 <记忆数> <提问内容>\n\n示例：gpt5 123456 你好")
-        
-        # 添加提示词
-        prompt = f"{question}\n\n注意：这是回答QQ平台的问题，请注意违禁词，避免涉政，涉黄，暴力，血腥，反人类，反人伦。"
-        
-        api_url = "https://api.jkyai.top/API/gpt5-nano/index.php"
-        params = {
-            "question": prompt,
-            "uid": uid
-        }
-        
-        try:
-            timeout = aiohttp.ClientTimeout(total=60)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(api_url, params=params) as resp:
-                    if resp.status != 200:
-                        return CommandResult().error(f"请求GPT5-nano助手失败，服务器返回错误状态码：{resp.status}")
-                    
-                    result = await resp.text()
-                    
-                    return CommandResult().message(result)
-                        
-        except aiohttp.ClientError as e:
-            logger.error(f"网络连接错误：{e}")
-            return CommandResult().error("无法连接到GPT5-nano助手服务器，请稍后重试或检查网络连接")
-        except asyncio.TimeoutError:
-            logger.error("请求超时")
-            return CommandResult().error("请求超时，请稍后重试")
-        except Exception as e:
-            logger.error(f"请求GPT5-nano助手时发生错误：{e}")
-            return CommandResult().error(f"请求GPT5-nano助手时发生错误：{str(e)}")
+        return await self._ask_model("gpt5", message)
 
     @filter.command("克劳德")
     async def claude_hiku(self, message: AstrMessageEvent):
         """Claude4.5-hiku助手，支持记忆功能"""
-        msg = message.message_str.replace("克劳德", "").strip()
-        
-        if not msg:
-            return CommandResult().error("正确指令：克劳德 <记忆数> <提问内容>\n\n示例：克劳德 123456 你好")
-        
-        # 分割输入，提取记忆数和问题
-        parts = msg.split(" ", 1)
-        if len(parts) != 2:
-            return CommandResult().error("正确格式：克劳德 <记忆数> <提问内容>\n\n示例：克劳德 123456 你好")
-        
-        uid = parts[0].strip()
-        question = parts[1].strip()
-        
-        # 验证记忆数是否为6位数字
-        if not uid.isdigit() or len(uid) != 6:
-            return CommandResult().error("记忆数必须是6位数字\n\n正确格式：克劳德 <记忆数> <提问内容>\n\n示例：克劳德 123456 你好")
-        
-        # 添加提示词
-        prompt = f"{question}\n\n注意：这是回答QQ平台的问题，请注意违禁词，避免涉政，涉黄，暴力，血腥，反人类，反人伦。"
-        
-        api_url = "https://api.jkyai.top/API/hiku-4.5/index.php"
-        params = {
-            "question": prompt,
-            "uid": uid
-        }
-        
-        try:
-            timeout = aiohttp.ClientTimeout(total=60)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(api_url, params=params) as resp:
-                    if resp.status != 200:
-                        return CommandResult().error(f"请求Claude4.5-hiku助手失败，服务器返回错误状态码：{resp.status}")
-                    
-                    result = await resp.text()
-                    
-                    return CommandResult().message(result)
-                        
-        except aiohttp.ClientError as e:
-            logger.error(f"网络连接错误：{e}")
-            return CommandResult().error("无法连接到Claude4.5-hiku助手服务器，请稍后重试或检查网络连接")
-        except asyncio.TimeoutError:
-            logger.error("请求超时")
-            return CommandResult().error("请求超时，请稍后重试")
-        except Exception as e:
-            logger.error(f"请求Claude4.5-hiku助手时发生错误：{e}")
-            return CommandResult().error(f"请求Claude4.5-hiku助手时发生错误：{str(e)}")
+        return await self._ask_model("克劳德", message)
 
     @filter.command("千问")
     async def qwen3_coder(self, message: AstrMessageEvent):
         """通义千问助手，支持记忆功能"""
-        msg = message.message_str.replace("千问", "").strip()
-        
-        if not msg:
-            return CommandResult().error("正确指令：千问 <记忆数> <提问内容>\n\n示例：千问 123456 你好")
-        
-        # 分割输入，提取记忆数和问题
-        parts = msg.split(" ", 1)
-        if len(parts) != 2:
-            return CommandResult().error("正确格式：千问 <记忆数> <提问内容>\n\n示例：千问 123456 你好")
-        
-        uid = parts[0].strip()
-        question = parts[1].strip()
-        
-        # 验证记忆数是否为6位数字
-        if not uid.isdigit() or len(uid) != 6:
-            return CommandResult().error("记忆数必须是6位数字\n\n正确格式：千问 <记忆数> <提问内容>\n\n示例：千问 123456 你好")
-        
-        # 添加违禁词提示
-        question_with_prompt = f"{question} 注意：这是回答QQ平台的问题，请注意违禁词，避免涉政，涉黄，暴力，血腥，反人类，反人伦。"
-        
-        api_url = "https://api.jkyai.top/API/qwen3-coder/index.php"
-        params = {
-            "question": question_with_prompt,
-            "uid": uid
-        }
-        
-        try:
-            timeout = aiohttp.ClientTimeout(total=60)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(api_url, params=params) as resp:
-                    if resp.status != 200:
-                        return CommandResult().error(f"请求通义千问助手失败，服务器返回错误状态码：{resp.status}")
-                    
-                    result = await resp.text()
-                    
-                    return CommandResult().message(result)
-                        
-        except aiohttp.ClientError as e:
-            logger.error(f"网络连接错误：{e}")
-            return CommandResult().error("无法连接到通义千问助手服务器，请稍后重试或检查网络连接")
-        except asyncio.TimeoutError:
-            logger.error("请求超时")
-            return CommandResult().error("请求超时，请稍后重试")
-        except Exception as e:
-            logger.error(f"请求通义千问助手时发生错误：{e}")
-            return CommandResult().error(f"请求通义千问助手时发生错误：{str(e)}")
+        return await self._ask_model("千问", message)
 
     @filter.command("deepR1")
     async def deepseek_r1(self, message: AstrMessageEvent):
         """DeepSeek-R1助手，支持异步请求"""
-        msg = message.message_str.replace("deepR1", "").strip()
-        
-        if not msg:
-            return CommandResult().error("正确指令：deepR1 <提问内容>\n\n示例：deepR1 1+1")
-        
-        question = msg.strip()
-        
-        # 添加违禁词提示
-        question_with_prompt = f"{question} 注意：这是回答QQ平台的问题，请注意违禁词，避免涉政，涉黄，暴力，血腥，反人类，反人伦。"
-        
-        api_url = "https://api.jkyai.top/API/deepseek.php"
-        params = {
-            "question": question_with_prompt
-        }
-        
-        try:
-            # 根据文档，该API响应速度较慢，设置较长超时时间
-            timeout = aiohttp.ClientTimeout(total=120)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(api_url, params=params) as resp:
-                    if resp.status != 200:
-                        return CommandResult().error(f"请求DeepSeek-R1助手失败，服务器返回错误状态码：{resp.status}")
-                    
-                    result = await resp.text()
-                    
-                    return CommandResult().message(result)
-                        
-        except aiohttp.ClientError as e:
-            logger.error(f"网络连接错误：{e}")
-            return CommandResult().error("无法连接到DeepSeek-R1助手服务器，请稍后重试或检查网络连接")
-        except asyncio.TimeoutError:
-            logger.error("请求超时")
-            return CommandResult().error("请求超时，请稍后重试")
-        except Exception as e:
-            logger.error(f"请求DeepSeek-R1助手时发生错误：{e}")
-            return CommandResult().error(f"请求DeepSeek-R1助手时发生错误：{str(e)}")
+        return await self._ask_model("deepR1", message)
 
     @filter.command("智谱")
     async def glm46(self, message: AstrMessageEvent):
         """智谱GLM4.6助手，支持异步请求"""
-        msg = message.message_str.replace("智谱", "").strip()
-        
-        if not msg:
-            return CommandResult().error("正确指令：智谱 <提问内容>\n\n示例：智谱 1+1")
-        
-        question = msg.strip()
-        
-        # 添加违禁词提示
-        question_with_prompt = f"{question} 注意：这是回答QQ平台的问题，请注意违禁词，避免涉政，涉黄，暴力，血腥，反人类，反人伦。"
-        
-        api_url = "https://api.jkyai.top/API/glm4.6.php"
-        params = {
-            "question": question_with_prompt
-        }
-        
-        try:
-            timeout = aiohttp.ClientTimeout(total=60)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(api_url, params=params) as resp:
-                    if resp.status != 200:
-                        return CommandResult().error(f"请求智谱GLM4.6助手失败，服务器返回错误状态码：{resp.status}")
-                    
-                    result = await resp.text()
-                    
-                    return CommandResult().message(result)
-                        
-        except aiohttp.ClientError as e:
-            logger.error(f"网络连接错误：{e}")
-            return CommandResult().error("无法连接到智谱GLM4.6助手服务器，请稍后重试或检查网络连接")
-        except asyncio.TimeoutError:
-            logger.error("请求超时")
-            return CommandResult().error("请求超时，请稍后重试")
-        except Exception as e:
-            logger.error(f"请求智谱GLM4.6助手时发生错误：{e}")
-            return CommandResult().error(f"请求智谱GLM4.6助手时发生错误：{str(e)}")
+        return await self._ask_model("智谱", message)
     
     @filter.command("夸克")
     async def kuaike_ai(self, message: AstrMessageEvent):
         """夸克AI助手，支持异步请求"""
-        msg = message.message_str.replace("夸克", "").strip()
-        
-        if not msg:
-            return CommandResult().error("正确指令：夸克 <提问内容>\n\n示例：夸克 1+1")
-        
-        content = msg.strip()
-        
-        # 添加违禁词提示
-        content_with_prompt = f"{content} 注意：这是回答QQ平台的问题，请注意违禁词，避免涉政，涉黄，暴力，血腥，反人类，反人伦。"
-        
-        api_url = "https://api.jkyai.top/API/kkaimx.php"
-        params = {
-            "content": content_with_prompt
-        }
-        
-        try:
-            timeout = aiohttp.ClientTimeout(total=60)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(api_url, params=params) as resp:
-                    if resp.status != 200:
-                        return CommandResult().error(f"请求夸克AI助手失败，服务器返回错误状态码：{resp.status}")
-                    
-                    result = await resp.text()
-                    
-                    return CommandResult().message(result)
-                        
-        except aiohttp.ClientError as e:
-            logger.error(f"网络连接错误：{e}")
-            return CommandResult().error("无法连接到夸克AI助手服务器，请稍后重试或检查网络连接")
-        except asyncio.TimeoutError:
-            logger.error("请求超时")
-            return CommandResult().error("请求超时，请稍后重试")
-        except Exception as e:
-            logger.error(f"请求夸克AI助手时发生错误：{e}")
-            return CommandResult().error(f"请求夸克AI助手时发生错误：{str(e)}")
+        return await self._ask_model("夸克", message)
     
     @filter.command("蚂蚁")
     async def ant_ling_ai(self, message: AstrMessageEvent):
         """蚂蚁Ling2.0-1tAI助手，支持异步请求"""
-        msg = message.message_str.replace("蚂蚁", "").strip()
-        
-        if not msg:
-            return CommandResult().error("正确指令：蚂蚁 <提问内容>\n\n示例：蚂蚁 1+1")
-        
-        question = msg.strip()
-        
-        # 添加违禁词提示
-        question_with_prompt = f"{question} 注意：这是回答QQ平台的问题，请注意违禁词，避免涉政，涉黄，暴力，血腥，反人类，反人伦。"
-        
-        api_url = "https://api.jkyai.top/API/ling-1t.php"
-        params = {
-            "question": question_with_prompt
-        }
-        
-        try:
-            timeout = aiohttp.ClientTimeout(total=120)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(api_url, params=params) as resp:
-                    if resp.status != 200:
-                        return CommandResult().error(f"请求蚂蚁AI助手失败，服务器返回错误状态码：{resp.status}")
-                    
-                    result = await resp.text()
-                    
-                    return CommandResult().message(result)
-                        
-        except aiohttp.ClientError as e:
-            logger.error(f"网络连接错误：{e}")
-            return CommandResult().error("无法连接到蚂蚁AI助手服务器，请稍后重试或检查网络连接")
-        except asyncio.TimeoutError:
-            logger.error("请求超时")
-            return CommandResult().error("请求超时，请稍后重试")
-        except Exception as e:
-            logger.error(f"请求蚂蚁AI助手时发生错误：{e}")
-            return CommandResult().error(f"请求蚂蚁AI助手时发生错误：{str(e)}")
+        return await self._ask_model("蚂蚁", message)
     
     @filter.command("豆包")
     async def doubao_ai(self, message: AstrMessageEvent):
         """字节跳动豆包AI助手，支持异步请求"""
-        msg = message.message_str.replace("豆包", "").strip()
-        
-        if not msg:
-            return CommandResult().error("正确指令：豆包 <提问内容>\n\n示例：豆包 1+1")
-        
-        question = msg.strip()
-        
-        # 添加违禁词提示
-        question_with_prompt = f"{question} 注意：这是回答QQ平台的问题，请注意违禁词，避免涉政，涉黄，暴力，血腥，反人类，反人伦。"
-        
-        api_url = "https://api.jkyai.top/API/doubao.php"
-        params = {
-            "question": question_with_prompt
-        }
-        
-        try:
-            timeout = aiohttp.ClientTimeout(total=60)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(api_url, params=params) as resp:
-                    if resp.status != 200:
-                        return CommandResult().error(f"请求豆包AI助手失败，服务器返回错误状态码：{resp.status}")
-                    
-                    result = await resp.text()
-                    
-                    return CommandResult().message(result)
-                        
-        except aiohttp.ClientError as e:
-            logger.error(f"网络连接错误：{e}")
-            return CommandResult().error("无法连接到豆包AI助手服务器，请稍后重试或检查网络连接")
-        except asyncio.TimeoutError:
-            logger.error("请求超时")
-            return CommandResult().error("请求超时，请稍后重试")
-        except Exception as e:
-            logger.error(f"请求豆包AI助手时发生错误：{e}")
-            return CommandResult().error(f"请求豆包AI助手时发生错误：{str(e)}")
+        return await self._ask_model("豆包", message)
     
     @filter.command("gpt")
     async def chatgpt_oss(self, message: AstrMessageEvent):
         """ChatGPT-ossAI助手，支持记忆功能"""
-        msg = message.message_str.replace("gpt", "").strip()
-        
-        if not msg:
-            return CommandResult().error("正确指令：gpt <记忆数> <提问内容>\n\n示例：gpt 123456 你好")
-        
-        # 分割输入，提取记忆数和问题
-        parts = msg.split(" ", 1)
-        if len(parts) != 2:
-            return CommandResult().error("正确格式：gpt <记忆数> <提问内容>\n\n示例：gpt 123456 你好")
-        
-        uid = parts[0].strip()
-        question = parts[1].strip()
-        
-        # 验证记忆数是否为6位数字
-        if not uid.isdigit() or len(uid) != 6:
-            return CommandResult().error("记忆数必须是6位数字\n\n正确格式：gpt <记忆数> <提问内容>\n\n示例：gpt 123456 你好")
-        
-        # 添加违禁词提示
-        question_with_prompt = f"{question} 注意：这是回答QQ平台的问题，请注意违禁词，避免涉政，涉黄，暴力，血腥，反人类，反人伦。"
-        
-        api_url = "https://api.jkyai.top/API/chatgpt-oss/index.php"
-        params = {
-            "question": question_with_prompt,
-            "uid": uid
-        }
-        
-        try:
-            timeout = aiohttp.ClientTimeout(total=60)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(api_url, params=params) as resp:
-                    if resp.status != 200:
-                        return CommandResult().error(f"请求ChatGPT-ossAI助手失败，服务器返回错误状态码：{resp.status}")
-                    
-                    result = await resp.text()
-                    
-                    return CommandResult().message(result)
-                        
-        except aiohttp.ClientError as e:
-            logger.error(f"网络连接错误：{e}")
-            return CommandResult().error("无法连接到ChatGPT-ossAI助手服务器，请稍后重试或检查网络连接")
-        except asyncio.TimeoutError:
-            logger.error("请求超时")
-            return CommandResult().error("请求超时，请稍后重试")
-        except Exception as e:
-            logger.error(f"请求ChatGPT-ossAI助手时发生错误：{e}")
-            return CommandResult().error(f"请求ChatGPT-ossAI助手时发生错误：{str(e)}")
+        return await self._ask_model("gpt", message)
     
     @filter.command("谷歌")
     async def gemini_ai(self, message: AstrMessageEvent):
         """Gemini-2.5AI助手，支持记忆功能"""
-        msg = message.message_str.replace("谷歌", "").strip()
-        
-        if not msg:
-            return CommandResult().error("正确指令：谷歌 <记忆数> <提问内容>\n\n示例：谷歌 123456 你好")
-        
-        # 分割输入，提取记忆数和问题
-        parts = msg.split(" ", 1)
-        if len(parts) != 2:
-            return CommandResult().error("正确格式：谷歌 <记忆数> <提问内容>\n\n示例：谷歌 123456 你好")
-        
-        uid = parts[0].strip()
-        question = parts[1].strip()
-        
-        # 验证记忆数是否为6位数字
-        if not uid.isdigit() or len(uid) != 6:
-            return CommandResult().error("记忆数必须是6位数字\n\n正确格式：谷歌 <记忆数> <提问内容>\n\n示例：谷歌 123456 你好")
-        
-        # 添加违禁词提示
-        question_with_prompt = f"{question} 注意：这是回答QQ平台的问题，请注意违禁词，避免涉政，涉黄，暴力，血腥，反人类，反人伦。"
-        
-        api_url = "https://api.jkyai.top/API/gemini2.5/index.php"
-        params = {
-            "question": question_with_prompt,
-            "uid": uid
-        }
-        
-        try:
-            timeout = aiohttp.ClientTimeout(total=60)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(api_url, params=params) as resp:
-                    if resp.status != 200:
-                        return CommandResult().error(f"请求谷歌Gemini-2.5AI助手失败，服务器返回错误状态码：{resp.status}")
-                    
-                    result = await resp.text()
-                    
-                    return CommandResult().message(result)
-                        
-        except aiohttp.ClientError as e:
-            logger.error(f"网络连接错误：{e}")
-            return CommandResult().error("无法连接到谷歌Gemini-2.5AI助手服务器，请稍后重试或检查网络连接")
-        except asyncio.TimeoutError:
-            logger.error("请求超时")
-            return CommandResult().error("请求超时，请稍后重试")
-        except Exception as e:
-            logger.error(f"请求谷歌Gemini-2.5AI助手时发生错误：{e}")
-            return CommandResult().error(f"请求谷歌Gemini-2.5AI助手时发生错误：{str(e)}")
-    
-    @filter.command("阿里")
-    async def qwen3_ai(self, message: AstrMessageEvent):
-        """阿里云千问Qwen3-235bAI助手，支持异步请求"""
-        msg = message.message_str.replace("阿里", "").strip()
-        
-        if not msg:
-            return CommandResult().error("正确指令：阿里 <提问内容>\n\n示例：阿里 1+1")
-        
-        question = msg.strip()
-        
-        # 添加违禁词提示
-        question_with_prompt = f"{question} 注意：这是回答QQ平台的问题，请注意违禁词，避免涉政，涉黄，暴力，血腥，反人类，反人伦。"
-        
-        api_url = "https://api.jkyai.top/API/qwen3.php"
-        params = {
-            "question": question_with_prompt
-        }
+        return await self._ask_model("谷歌", message)
+    
+    @filter.command("阿里")
+    async def qwen3_ai(self, message: AstrMessageEvent):
+        """阿里云千问Qwen3-235bAI助手，支持异步请求"""
+        return await self._ask_model("阿里", message)
+    
+    @filter.command("讯飞")
+    async def xfxhx1_ai(self, message: AstrMessageEvent):
+        """讯飞星火X1AI助手，支持异步请求"""
+        return await self._ask_model("讯飞", message)
+    
+    @filter.command("小米")
+    async def xiaomi_mimo(self, message: AstrMessageEvent):
+        """小米MiMo-V2助手，支持记忆功能"""
+        return await self._ask_model("小米", message)
+
+    async def _ask_model(self, command: str, message: AstrMessageEvent):
+        """按注册表解析指令并调用对应的大模型，所有问答指令共用此流程"""
+        spec = MODELS[command]
+        msg = message.message_str.replace(spec.command, "").strip()
+        
+        if spec.needs_uid:
+            usage = f"{spec.command} <记忆数> <提问内容>\n\n示例：{spec.command} 123456 你好"
+            if not msg:
+                return CommandResult().error(f"正确指令：{usage}")
+            
+            # 分割输入，提取记忆数和问题
+            parts = msg.split(" ", 1)
+            if len(parts) != 2:
+                return CommandResult().error(f"正确格式：{usage}")
+            
+            uid = parts[0].strip()
+            question = parts[1].strip()
+            
+            # 验证记忆数是否为6位数字
+            if not uid.isdigit() or len(uid) != 6:
+                return CommandResult().error(f"记忆数必须是6位数字\n\n正确格式：{usage}")
+        else:
+            if not msg:
+                return CommandResult().error(f"正确指令：{spec.command} <提问内容>\n\n示例：{spec.command} 1+1")
+            question = msg
+            uid = None
+        
+        # 耗时较长的模型在支持的平台上边接收边发送
+        stream = None
+        if spec.stream and message.get_platform_name() in STREAM_PLATFORMS:
+            stream = StreamingReply(message)
         
         try:
-            timeout = aiohttp.ClientTimeout(total=60)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(api_url, params=params) as resp:
-                    if resp.status != 200:
-                        return CommandResult().error(f"请求阿里AI助手失败，服务器返回错误状态码：{resp.status}")
-                    
-                    result = await resp.text()
-                    
-                    return CommandResult().message(result)
-                        
+            result = await self._answer(spec, question, uid, stream)
+            if stream is not None and stream.sent:
+                # 已经分段发送过的内容不再重复发送
+                result = stream.pending()
+                if not result:
+                    return None
+            return CommandResult().message(result)
+        except UpstreamStatusError as e:
+            return CommandResult().error(f"请求{spec.name}失败，服务器返回错误状态码：{e.status}")
+        except BulkheadFullError:
+            return CommandResult().error(BUSY_MESSAGE)
+        except CircuitOpenError as e:
+            return CommandResult().error(f"{spec.name}{e}")
         except aiohttp.ClientError as e:
             logger.error(f"网络连接错误：{e}")
-            return CommandResult().error("无法连接到阿里AI助手服务器，请稍后重试或检查网络连接")
+            return CommandResult().error(f"无法连接到{spec.name}服务器，请稍后重试或检查网络连接")
         except asyncio.TimeoutError:
             logger.error("请求超时")
             return CommandResult().error("请求超时，请稍后重试")
         except Exception as e:
-            logger.error(f"请求阿里AI助手时发生错误：{e}")
-            return CommandResult().error(f"请求阿里AI助手时发生错误：{str(e)}")
-    
-    @filter.command("讯飞")
-    async def xfxhx1_ai(self, message: AstrMessageEvent):
-        """讯飞星火X1AI助手，支持异步请求"""
-        msg = message.message_str.replace("讯飞", "").strip()
+            logger.error(f"请求{spec.name}时发生错误：{e}")
+            return CommandResult().error(f"请求{spec.name}时发生错误：{str(e)}")
+
+    async def _answer(self, spec: ModelSpec, question: str, uid: str = None, stream: StreamingReply = None,
+                      use_cache: bool = True) -> str:
+        """向模型提问并返回完整回答文本，单次问答模型优先使用回答缓存；传入stream时边接收边分段发送
+
+        use_cache为False时不读取缓存（调用方已经查过），回答仍会写入缓存。
+        """
+        # 单次问答模型的回答只取决于问题本身，可以直接复用缓存
+        cache_key = None
+        if not spec.needs_uid and spec.cache_ttl > 0:
+            cache_key = (spec.command, normalize_question(question))
+            cached = self.answer_cache.get(cache_key) if use_cache else None
+            if cached is not None:
+                logger.debug(f"{spec.name}命中回答缓存")
+                return cached
+        
+        params = {"uid": uid} if spec.needs_uid else {}
+        # 添加违禁词提示
+        params[spec.param] = f"{question}{spec.prompt_sep}{SAFETY_PROMPT}"
+        
+        if stream is not None:
+            # 流式回答由各自的请求独占读取，不参与请求合并和对冲
+            result = await self._send("GET", spec.endpoint, params, None, spec.timeout, on_text=stream.feed)
+        else:
+            result = await self._request_model(spec, params)
+        if cache_key is not None and result.strip():
+            self.answer_cache.set(cache_key, result, spec.cache_ttl)
+        return result
+
+    @filter.command("最快")
+    async def zui_kuai(self, message: AstrMessageEvent):
+        """同时询问多个单次问答模型，返回最先成功的回答"""
+        msg = message.message_str.replace("最快", "").strip()
         
         if not msg:
-            return CommandResult().error("正确指令：讯飞 <提问内容>\n\n示例：讯飞 1+1")
-        
-        content = msg.strip()
-        
-        # 添加违禁词提示
-        content_with_prompt = f"{content} 注意：这是回答QQ平台的问题，请注意违禁词，避免涉政，涉黄，暴力，血腥，反人类，反人伦。"
+            return CommandResult().error("正确指令：最快 <提问内容>\n\n示例：最快 1+1")
         
-        api_url = "https://api.jkyai.top/API/xfxhx1.php"
-        params = {
-            "content": content_with_prompt
+        question = msg.strip()
+        # 有模型的回答已缓存时直接返回，不参与竞速，也不计入胜出统计，避免缓存命中的0秒“胜出”干扰用时数据；
+        # 逐个模型查看缓存不计入命中率，整条指令只计为一次查询
+        for command in RACE_MODELS:
+            spec = MODELS[command]
+            if spec.needs_uid or spec.cache_ttl <= 0:
+                continue
+            cached = self.answer_cache.peek((spec.command, normalize_question(question)))
+            if cached is not None and cached.strip():
+                self.answer_cache.hits += 1
+                return CommandResult().message(f"{cached}\n\n—— {spec.name}（缓存的回答）")
+        self.answer_cache.misses += 1
+        
+        start = time.monotonic()
+        tasks = {
+            asyncio.ensure_future(self._answer(MODELS[command], question, use_cache=False)): MODELS[command]
+            for command in RACE_MODELS
         }
-        
+        pending = set(tasks)
         try:
-            # API文档显示响应耗时较长（6.70s），设置较长超时时间
-            timeout = aiohttp.ClientTimeout(total=120)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(api_url, params=params) as resp:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    spec = tasks[task]
+                    error = task.exception()
+                    if error is not None:
+                        logger.debug(f"最快模式中{spec.name}请求失败：{error}")
+                        continue
+                    result = task.result()
+                    if not result.strip():
+                        continue
+                    elapsed = time.monotonic() - start
+                    self.race_stats.record_win(spec.command, elapsed)
+                    logger.info(f"最快模式由{spec.name}胜出，用时{elapsed:.2f}秒")
+                    return CommandResult().message(f"{result}\n\n—— {spec.name}，用时{elapsed:.1f}秒")
+            
+            self.race_stats.failures += 1
+            return CommandResult().error("所有模型都请求失败，请稍后重试")
+        finally:
+            # 取消落后的请求，尽快释放连接
+            for task in pending:
+                task.cancel()
+
+    async def _request_model(self, spec: ModelSpec, params: dict) -> str:
+        """请求引擎：按注册表中的配置发起请求并返回回答文本"""
+        policy = NO_RETRY_POLICY if spec.needs_uid else spec.policy
+        return await self._http_request("GET", spec.endpoint, params=params, timeout=spec.timeout, policy=policy)
+
+    async def _http_request(self, method: str, url: str, params: dict = None, json_body: dict = None,
+                            timeout: float = 60, policy: RequestPolicy = NO_RETRY_POLICY) -> str:
+        """发起上游请求并返回响应文本，相同的并发请求合并为一次"""
+        key = (method, url, flight_key(params), flight_key(json_body))
+        return await self._flights.do(key, lambda: self._send_with_policy(method, url, params, json_body, timeout, policy))
+
+    async def _send_with_policy(self, method: str, url: str, params: dict, json_body: dict, timeout: float,
+                                policy: RequestPolicy) -> str:
+        """按请求策略发送请求，重试和对冲都不会超过整体超时时间
+
+        一次请求（包括它的所有重试）最多向熔断器记录一次失败，避免少量请求的重试就把接口熔断。
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        breaker = self._get_breaker(url)
+        attempt = 0
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                if attempt > 0:
+                    breaker.record_failure()
+                raise asyncio.TimeoutError()
+            try:
+                # 重试只能使用剩余的时间，超时不计入熔断
+                if policy.hedge and method == "GET":
+                    return await self._send_hedged(method, url, params, json_body, deadline, policy,
+                                                   truncated=attempt > 0)
+                return await self._send(method, url, params, json_body, remaining,
+                                        truncated=attempt > 0, defer_failure=True)
+            except asyncio.TimeoutError:
+                if attempt > 0:
+                    # 重试本身的超时不计入熔断，但之前的尝试已经失败，整个请求计为一次失败
+                    breaker.record_failure()
+                raise
+            except (aiohttp.ClientError, UpstreamStatusError) as e:
+                if method != "GET" or attempt >= policy.max_retries or not is_retryable(e):
+                    breaker.record_failure()
+                    raise
+                # 指数退避，并加入随机抖动避免大量请求同时重试
+                delay = random.uniform(0, min(policy.backoff_max, policy.backoff_base * 2 ** attempt))
+                if loop.time() + delay >= deadline:
+                    breaker.record_failure()
+                    raise
+                attempt += 1
+                self._request_stats["retries"] += 1
+                logger.warning(f"请求 {url} 失败（{e}），{delay:.2f}秒后进行第{attempt}次重试")
+                await asyncio.sleep(delay)
+
+    async def _send_hedged(self, method: str, url: str, params: dict, json_body: dict, deadline: float,
+                           policy: RequestPolicy, truncated: bool = False) -> str:
+        """先发送一个请求，耗时超过近期P95仍未返回时再发送一个相同请求，取先成功的结果"""
+        loop = asyncio.get_running_loop()
+        primary = asyncio.ensure_future(
+            self._send(method, url, params, json_body, deadline - loop.time(), truncated=truncated, defer_failure=True)
+        )
+        pending = {primary}
+        try:
+            p95 = self._get_latency(url).percentile(0.95)
+            if p95 is not None:
+                delay = max(policy.hedge_min_delay, p95)
+                if loop.time() + delay < deadline:
+                    done, _ = await asyncio.wait(pending, timeout=delay)
+                    if not done:
+                        self._request_stats["hedges"] += 1
+                        # 对冲请求只有剩余的时间，超时不计入熔断
+                        pending.add(asyncio.ensure_future(
+                            self._send(method, url, params, json_body, deadline - loop.time(), truncated=True,
+                                       defer_failure=True)
+                        ))
+            
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self._request_stats["hedge_wins"] += 1
+                        return task.result()
+            # 两个请求都失败时，优先抛出原始请求的异常
+            raise primary.exception()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _get_latency(self, url: str) -> LatencyTracker:
+        """获取接口的耗时统计"""
+        tracker = self._latencies.get(url)
+        if tracker is None:
+            tracker = LatencyTracker()
+            self._latencies[url] = tracker
+        return tracker
+
+    def _get_bulkhead(self, url: str, host: str = None) -> Bulkhead:
+        """获取接口级（传入url）或主机级（传入host）的隔离舱"""
+        key = host or url
+        bulkhead = self._bulkheads.get(key)
+        if bulkhead is None:
+            if host:
+                limit, max_queue = HOST_BULKHEADS.get(host, DEFAULT_HOST_BULKHEAD)
+            else:
+                limit, max_queue = ENDPOINT_BULKHEADS.get(url, DEFAULT_ENDPOINT_BULKHEAD)
+            bulkhead = Bulkhead(key, limit, max_queue, BULKHEAD_MAX_WAIT)
+            self._bulkheads[key] = bulkhead
+        return bulkhead
+
+    def _get_breaker(self, url: str) -> CircuitBreaker:
+        """获取接口对应的熔断器"""
+        breaker = self._breakers.get(url)
+        if breaker is None:
+            breaker = CircuitBreaker(url, BREAKER_FAILURE_THRESHOLD, BREAKER_RECOVERY_TIMEOUT)
+            self._breakers[url] = breaker
+        return breaker
+
+    async def _send(self, method: str, url: str, params: dict, json_body: dict, timeout: float,
+                    on_text=None, truncated: bool = False, defer_failure: bool = False) -> str:
+        """经过熔断器和隔离舱执行一次HTTP请求，非200状态码抛出UpstreamStatusError
+
+        timeout应为接口正常的超时时间；truncated表示本次超时时间被调用方截短（重试、对冲），
+        此时超时不能说明接口异常，只释放熔断器的探测名额，不计为失败。
+        defer_failure表示连接错误和错误状态码由调用方在确定不再重试后统一记录，这里只释放探测名额。
+        """
+        breaker = self._get_breaker(url)
+        if not breaker.allow():
+            raise CircuitOpenError(url, breaker.retry_after())
+        
+        host = urllib.parse.urlsplit(url).netloc
+        try:
+            async with self._get_bulkhead(url).acquire(), self._get_bulkhead(url, host=host).acquire():
+                session = self._get_session(url)
+                client_timeout = aiohttp.ClientTimeout(total=timeout)
+                start = time.monotonic()
+                async with session.request(method, url, params=params, json=json_body, timeout=client_timeout) as resp:
                     if resp.status != 200:
-                        return CommandResult().error(f"请求讯飞AI助手失败，服务器返回错误状态码：{resp.status}")
-                    
-                    result = await resp.text()
-                    
-                    return CommandResult().message(result)
-                        
-        except aiohttp.ClientError as e:
-            logger.error(f"网络连接错误：{e}")
-            return CommandResult().error("无法连接到讯飞AI助手服务器，请稍后重试或检查网络连接")
+                        raise UpstreamStatusError(resp.status, await read_text(resp))
+                    text = await read_text(resp, on_text=on_text)
         except asyncio.TimeoutError:
-            logger.error("请求超时")
-            return CommandResult().error("请求超时，请稍后重试")
-        except Exception as e:
-            logger.error(f"请求讯飞AI助手时发生错误：{e}")
-            return CommandResult().error(f"请求讯飞AI助手时发生错误：{str(e)}")
+            if truncated:
+                breaker.release()
+            else:
+                breaker.record_failure()
+            raise
+        except (aiohttp.ClientError, UpstreamStatusError):
+            if defer_failure:
+                breaker.release()
+            else:
+                breaker.record_failure()
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+        breaker.record_success()
+        self._get_latency(url).record(time.monotonic() - start)
+        return text
     
-    @filter.command("小米")
-    async def xiaomi_mimo(self, message: AstrMessageEvent):
-        """小米MiMo-V2助手，支持记忆功能"""
-        msg = message.message_str.replace("小米", "").strip()
-        
-        if not msg:
-            return CommandResult().error("正确指令：小米 <记忆数> <提问内容>\n\n示例：小米 123456 你好")
-        
-        # 分割输入，提取记忆数和问题
-        parts = msg.split(" ", 1)
-        if len(parts) != 2:
-            return CommandResult().error("正确格式：小米 <记忆数> <提问内容>\n\n示例：小米 123456 你好")
-        
-        uid = parts[0].strip()
-        question = parts[1].strip()
+    async def _search_backend(self, backend: SearchBackend, query: str) -> list:
+        """查询单个搜索来源，返回SearchResult列表
+
+        相同的并发搜索会合并为一次，请求始终使用SEARCH_TIMEOUT，由_search按调用方的时间限制等待。
+        """
+        params = {backend.query_param: query, **dict(backend.extra_params)}
+        if backend.method == "GET":
+            text = await self._http_request("GET", backend.url, params=params, timeout=SEARCH_TIMEOUT)
+        else:
+            text = await self._http_request(backend.method, backend.url, json_body=params, timeout=SEARCH_TIMEOUT)
+        results = []
+        for item in json.loads(text).get(backend.results_field) or []:
+            title = item.get(backend.title_field) or ""
+            snippet = item.get(backend.snippet_field) or ""
+            if title and snippet:
+                results.append(SearchResult(
+                    title, snippet, item.get(backend.url_field) or "", item.get(backend.time_field) or "", backend.name
+                ))
+        return results
+
+    async def _search(self, query: str, timeout: float) -> list:
+        """同时查询所有搜索来源，在共同的截止时间内合并已返回的结果并去重
+
+        到期未返回的来源被取消，不会拖慢整体；所有来源都失败时抛出最后一个错误。
+        相同的问题在SEARCH_CACHE_TTL内直接复用上次的结果。
+        """
+        key = normalize_question(query)
+        cached = self.search_cache.get(key)
+        if cached is not None:
+            return cached
+        backends = [backend for backend in SEARCH_BACKENDS if backend.enabled]
+        tasks = {asyncio.ensure_future(self._search_backend(backend, query)): backend for backend in backends}
+        try:
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+        ranked = []
+        error = None
+        for task, backend in tasks.items():
+            stats = self.search_stats.setdefault(backend.name, [0, 0, 0, 0])
+            if task in pending:
+                stats[2] += 1
+                logger.warning(f"搜索来源 {backend.name} 未在{timeout:.1f}秒内返回，已忽略")
+                continue
+            if task.exception() is not None:
+                error = task.exception()
+                stats[1] += 1
+                logger.warning(f"搜索来源 {backend.name} 请求失败：{error!r}")
+                continue
+            stats[0] += 1
+            stats[3] += len(task.result())
+            ranked.append(task.result())
+        if not ranked:
+            raise error if error is not None else asyncio.TimeoutError()
+        results = dedupe_results(interleave(ranked))
+        if results:
+            self.search_cache.set(key, results, SEARCH_CACHE_TTL, size=sum(result.size() for result in results))
+        return results
+
+    def _search_answer_latency(self, context_chars: int) -> LatencyTracker:
+        """按搜索信息字符数所在的分组返回回答耗时统计，用于比较不同字符预算下的回答速度"""
+        bucket = next((limit for limit in SEARCH_LATENCY_BUCKETS if context_chars <= limit), None)
+        label = f"≤{bucket}字" if bucket is not None else f">{SEARCH_LATENCY_BUCKETS[-1]}字"
+        tracker = self._search_latency.get(label)
+        if tracker is None:
+            tracker = self._search_latency[label] = LatencyTracker(min_samples=1)
+        return tracker
+
+    async def _search_answer(self, question: str, deadline: Deadline) -> str:
+        """联网回答：搜索、本地重排并截取搜索信息，再交给DeepSeek-3.2回答"""
+        start = time.monotonic()
         
-        # 验证记忆数是否为6位数字
-        if not uid.isdigit() or len(uid) != 6:
-            return CommandResult().error("记忆数必须是6位数字\n\n正确格式：小米 <记忆数> <提问内容>\n\n示例：小米 123456 你好")
+        # 1. 同时查询各搜索来源，合并去重，为大模型回答至少预留LLM_MIN_BUDGET秒
+        try:
+            search_timeout = deadline.timeout(SEARCH_TIMEOUT, reserve=LLM_MIN_BUDGET)
+            results = await deadline.run("联网搜索", self._search(question, search_timeout))
+        except UpstreamStatusError as e:
+            raise SearchFailedError(e.status) from e
+
+        # 2. 在本地按相关度重新排序候选结果，并截取到字符预算以内
+        context = build_search_context(bm25_rank(question, results[:SEARCH_CANDIDATE_POOL]))
         
-        # 添加违禁词提示
-        question_with_prompt = f"{question} 注意：这是回答QQ平台的问题，请注意违禁词，避免涉政，涉黄，暴力，血腥，反人类，反人伦。"
+        # 3. 构建给DeepSeek-3.2的问题
+        combined_question = f"用户的问题是：{question}\n\n请结合以下搜索信息回答用户问题：\n{context}\n\n注意：这是回答QQ平台的问题，请注意违禁词，避免涉政，涉黄，暴力，血腥，反人类，反人伦。\n\n可以详细的回答用户为什么是这个答案，要简洁明了，可以解释原因"
         
-        api_url = "https://api.jkyai.top/API/xiaomi/index.php"
-        params = {
-            "question": question_with_prompt,
-            "uid": uid
+        # 4. 调用DeepSeek-3.2API
+        deepseek_url = "https://api.jkyai.top/API/depsek3.2.php"
+        deepseek_params = {
+            "question": combined_question
         }
         
+        answer_start = time.monotonic()
+        # 请求使用接口正常的超时时间（可能与其他相同的请求合并），由deadline.run按剩余时间限制等待
+        ai_result = await deadline.run("大模型回答", self._http_request(
+            "GET", deepseek_url, params=deepseek_params, timeout=LIAN_WANG_BUDGET, policy=STATELESS_POLICY,
+        ), minimum=LLM_MIN_BUDGET)
+        self._search_answer_latency(len(context)).record(time.monotonic() - answer_start)
+        self.speculation_stats.search_latency.record(time.monotonic() - start)
+        return ai_result
+
+    def _speculation_allowed(self, question: str) -> bool:
+        """问题明显需要最新信息时不做推测，避免白白多一次请求"""
+        return (
+            SEARCH_SPECULATIVE_MODE != "off"
+            and not any(word in question for word in SEARCH_FRESHNESS_WORDS)
+            and SEARCH_FRESHNESS_PATTERN.search(question) is None
+        )
+
+    async def _speculative_answer(self, question: str, deadline: Deadline):
+        """同时发起不带搜索信息的直接回答和联网回答，按推测策略选择结果并取消另一个
+
+        返回(回答文本, 是否为直接回答)。直接回答表示不知道最新信息时视为无效，继续等待联网回答。
+        """
+        stats = self.speculation_stats
+        if not self._speculation_allowed(question):
+            stats.skipped += 1
+            return await self._search_answer(question, deadline), False
+        
+        start = time.monotonic()
+        direct = asyncio.ensure_future(deadline.run("直接回答", self._answer(MODELS[SEARCH_SPECULATIVE_MODEL], question)))
+        searched = asyncio.ensure_future(self._search_answer(question, deadline))
+        pending = {direct, searched}
+        direct_answer = None
+        search_error = None
+        grace_deadline = deadline.expires_at
+        stats.runs += 1
         try:
-            timeout = aiohttp.ClientTimeout(total=60)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(api_url, params=params) as resp:
-                    if resp.status != 200:
-                        return CommandResult().error(f"请求小米MiMo-V2助手失败，服务器返回错误状态码：{resp.status}")
-                    
-                    result = await resp.text()
-                    
-                    return CommandResult().message(result)
-                        
-        except aiohttp.ClientError as e:
-            logger.error(f"网络连接错误：{e}")
-            return CommandResult().error("无法连接到小米MiMo-V2助手服务器，请稍后重试或检查网络连接")
-        except asyncio.TimeoutError:
-            logger.error("请求超时")
-            return CommandResult().error("请求超时，请稍后重试")
-        except Exception as e:
-            logger.error(f"请求小米MiMo-V2助手时发生错误：{e}")
-            return CommandResult().error(f"请求小米MiMo-V2助手时发生错误：{str(e)}")
-    
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=min(deadline.expires_at, grace_deadline) - time.monotonic(),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    break
+                if searched in done:
+                    search_error = searched.exception()
+                    if search_error is None:
+                        stats.record_search_win()
+                        return searched.result(), False
+                    logger.warning(f"联网模式的联网回答失败，等待直接回答：{search_error!r}")
+                if direct in done and direct.exception() is None:
+                    answer = direct.result()
+                    if answer.strip() and not any(phrase in answer for phrase in SEARCH_UNSURE_PHRASES):
+                        direct_answer = answer
+                        if SEARCH_SPECULATIVE_MODE == "fastest" or searched.done():
+                            break
+                        # 直接回答已就绪，联网回答最多再等待宽限时间
+                        grace_deadline = time.monotonic() + SEARCH_SPECULATIVE_GRACE
+            
+            if direct_answer is not None:
+                stats.record_direct_win(time.monotonic() - start, cancelled_search=not searched.done())
+                return direct_answer, True
+            stats.failures += 1
+            if search_error is not None:
+                raise search_error
+            raise DeadlineExceededError("联网回答")
+        finally:
+            for task in (direct, searched):
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()  # 取出落选请求的异常，避免未处理异常的警告
+
     @filter.command("联网模式")
     async def lian_wang_mo_xing(self, message: AstrMessageEvent):
         """联网模式，结合搜索引擎和AI进行问答"""
@@ -721,61 +2654,29 @@ class Main(Star):
         
         question = msg.strip()
         
+        # 搜索和AI回答共用LIAN_WANG_BUDGET秒的截止时间
+        deadline = Deadline("联网模式", LIAN_WANG_BUDGET)
         try:
-            # 1. 调用搜索引擎API获取相关信息
-            search_url = "https://uapis.cn/api/v1/search/aggregate"
-            search_params = {
-                "query": question,
-                "timeout_ms": 30000,
-                "sort": "date"  # 按日期排序
-            }
-            
-            timeout = aiohttp.ClientTimeout(total=60)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                # 发送搜索引擎请求
-                async with session.post(search_url, json=search_params) as search_resp:
-                    if search_resp.status != 200:
-                        return CommandResult().error(f"搜索引擎请求失败，服务器返回错误状态码：{search_resp.status}")
-                    
-                    search_result = await search_resp.json()
-                    
-                    # 2. 整理搜索结果，提取标题、片段和发布日期
-                    search_info = []
-                    for item in search_result.get("results", [])[:5]:  # 取前5条结果
-                        title = item.get("title", "")
-                        snippet = item.get("snippet", "")
-                        publish_time = item.get("publish_time", "")
-                        if title and snippet:
-                            # 简化发布日期格式
-                            if publish_time:
-                                # 将ISO格式转换为YYYY-MM-DD格式
-                                simple_time = publish_time.split("T")[0]
-                            else:
-                                simple_time = ""
-                            search_info.append(f"标题：{title}\n片段：{snippet}\n发布日期：{simple_time}\n")
-                    
-                    # 3. 构建给DeepSeek-3.2的问题
-                    combined_question = f"用户的问题是：{question}\n\n请结合以下搜索信息回答用户问题：\n{''.join(search_info)}\n\n注意：这是回答QQ平台的问题，请注意违禁词，避免涉政，涉黄，暴力，血腥，反人类，反人伦。\n\n可以详细的回答用户为什么是这个答案，要简洁明了，可以解释原因"
-                    
-                    # 4. 调用DeepSeek-3.2API
-                    deepseek_url = "https://api.jkyai.top/API/depsek3.2.php"
-                    deepseek_params = {
-                        "question": combined_question
-                    }
-                    
-                    async with session.get(deepseek_url, params=deepseek_params) as deepseek_resp:
-                        if deepseek_resp.status != 200:
-                            return CommandResult().error(f"DeepSeek-3.2请求失败，服务器返回错误状态码：{deepseek_resp.status}")
-                        
-                        ai_result = await deepseek_resp.text()
-                        
-                        return CommandResult().message(ai_result)
-                        
+            answer, direct = await self._speculative_answer(question, deadline)
+            if direct:
+                return CommandResult().message(f"{answer}\n\n—— 直接回答，未使用搜索结果")
+            return CommandResult().message(answer)
+        
+        except SearchFailedError as e:
+            return CommandResult().error(str(e))
+        except UpstreamStatusError as e:
+            return CommandResult().error(f"DeepSeek-3.2请求失败，服务器返回错误状态码：{e.status}")
+        except BulkheadFullError:
+            return CommandResult().error(BUSY_MESSAGE)
+        except CircuitOpenError as e:
+            return CommandResult().error(f"联网模式{e}")
         except aiohttp.ClientError as e:
             logger.error(f"网络连接错误：{e}")
             return CommandResult().error("网络连接错误，请稍后重试")
-        except asyncio.TimeoutError:
+        except asyncio.TimeoutError as e:
             logger.error("请求超时")
+            if isinstance(e, DeadlineExceededError):
+                deadline.log_timeout("联网回答")
             return CommandResult().error("请求超时，请稍后重试")
         except Exception as e:
             logger.error(f"联网模型请求时发生错误：{e}")
@@ -783,26 +2684,35 @@ class Main(Star):
 
     async def terminate(self):
         """插件卸载/重载时调用"""
-        pass
-        
-    async def extract_image_from_event(self, event: AstrMessageEvent) -> str:
-        """从事件中提取图片URL"""
+        if self._warm_up_task is not None and not self._warm_up_task.done():
+            self._warm_up_task.cancel()
+        self.render_cache.close()
+        self.waiting_sessions.close()
+        for stage in self._pipeline.values():
+            stage.close()
+        for pool in self._process_pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+        self._process_pools.clear()
+        
+        # 关闭所有共享的HTTP会话
+        sessions = list(self._sessions.values())
+        self._sessions.clear()
+        for session in sessions:
+            if not session.closed:
+                await session.close()
+        
+    async def extract_images_from_event(self, event: AstrMessageEvent) -> list:
+        """从事件中提取所有图片URL：先是当前消息中的图片，再是引用消息中的图片，按出现顺序去重"""
         messages = event.get_messages()
+        image_urls = []
 
         # 首先检查当前消息中的图片
         for msg in messages:
             # 标准图片组件
             if isinstance(msg, MsgImage):
-                if hasattr(msg, "url") and msg.url:
-                    return msg.url.strip()
-                if hasattr(msg, "file") and msg.file:
-                    # 从file字段提取URL - 处理微信格式
-                    file_content = str(msg.file)
-                    if "http" in file_content:
-                        # 提取URL并移除反引号
-                        urls = re.findall(r"https?://[^\s\`\']+", file_content)
-                        if urls:
-                            return urls[0].strip("`'")
+                image_url = image_url_of(msg)
+                if image_url and image_url not in image_urls:
+                    image_urls.append(image_url)
 
             # QQ官方平台特殊处理
             if hasattr(msg, "type") and msg.type == "Plain":
@@ -821,206 +2731,408 @@ class Main(Star):
                         # 在引用消息的chain中查找图片
                         for reply_msg in msg.chain:
                             if isinstance(reply_msg, MsgImage):
-                                if hasattr(reply_msg, "url") and reply_msg.url:
-                                    return reply_msg.url.strip()
-                                if hasattr(reply_msg, "file") and reply_msg.file:
-                                    file_content = str(reply_msg.file)
-                                    if "http" in file_content:
-                                        urls = re.findall(r"https?://[^\s\`\']+", file_content)
-                                        if urls:
-                                            return urls[0].strip("`'")
+                                image_url = image_url_of(reply_msg)
+                                if image_url and image_url not in image_urls:
+                                    image_urls.append(image_url)
 
         except Exception as e:
             logger.warning(f"检查引用消息图片时出错: {str(e)}")
 
-        return None
+        return image_urls
         
-    async def timeout_check(self, user_id: str, event: AstrMessageEvent):
-        """检查用户发送图片是否超时"""
+    async def _on_waiting_expired(self, records: list):
+        """向等待图片超时的会话发送提示"""
+        for record in records:
+            try:
+                await self.context.send_message(
+                    record.umo, MessageChain().message("⏰ 图片发送超时，请重新发送命令开始新的请求")
+                )
+            except Exception as e:
+                logger.error(f"超时检查出错: {str(e)}")
+            
+    async def _fetch_image(self, image_url: str, timeout: float = IMAGE_DOWNLOAD_TIMEOUT) -> bytes:
+        """下载图片内容并按文件头校验格式
+
+        超过IMAGE_MAX_DOWNLOAD_BYTES时抛出ImageTooLargeError，不是图片时抛出UnsupportedImageError。
+        图片URL每次都不同，只经过主机级隔离舱，不为其单独建立熔断器和耗时统计。
+        """
+        host = urllib.parse.urlsplit(image_url).netloc
+        async with self._get_bulkhead(image_url, host=host).acquire():
+            session = self._get_session(image_url)
+            client_timeout = aiohttp.ClientTimeout(total=timeout)
+            async with session.get(image_url, timeout=client_timeout) as resp:
+                if resp.status != 200:
+                    raise UpstreamStatusError(resp.status)
+                data = await read_bytes(resp, IMAGE_MAX_DOWNLOAD_BYTES)
+        if sniff_image_type(data) is None:
+            logger.warning(f"下载内容不是图片，Content-Type：{resp.content_type}，URL：{image_url}")
+            raise UnsupportedImageError()
+        return data
+
+    async def _prefetch_image(self, image_url: str, deadline: Deadline = None):
+        """下载图片用于OCR；图片过大或格式不支持时抛出异常，其他下载失败返回None"""
+        timeout = deadline.timeout(IMAGE_DOWNLOAD_TIMEOUT) if deadline is not None else IMAGE_DOWNLOAD_TIMEOUT
         try:
-            await asyncio.sleep(30)  # 等待30秒
-            if user_id in self.waiting_sessions:
-                # 超时，发送消息
-                await event.send(event.plain_result("⏰ 图片发送超时，请重新发送命令开始新的请求"))
-                # 清理会话和超时任务
-                del self.waiting_sessions[user_id]
-                if user_id in self.timeout_tasks:
-                    del self.timeout_tasks[user_id]
-        except asyncio.CancelledError:
-            # 任务被取消，说明用户已经发送了图片
-            pass
+            return await self._fetch_image(image_url, timeout)
+        except (ImageTooLargeError, UnsupportedImageError):
+            raise
         except Exception as e:
-            logger.error(f"超时检查出错: {str(e)}")
-            
-    async def ocr_recognize(self, image_url: str) -> str:
-        """调用OCR API识别图片中的文字"""
+            # 下载失败时仍交给OCR接口自行下载，只是无法使用缓存
+            logger.warning(f"下载图片失败，跳过OCR缓存：{e}")
+            return None
+
+    async def _recognize_image(self, image_url: str, data: bytes = None, deadline: Deadline = None) -> str:
+        """识别已下载的图片，相同内容的图片直接复用OCR缓存；没有图片内容时交给OCR接口按URL下载"""
+        if data is None:
+            return await self._recognize(image_url, deadline=deadline)
+        
+        digest = hashlib.sha256(data).hexdigest()
+        cached = self.ocr_cache.get(digest)
+        if cached is not None:
+            logger.info(f"命中OCR缓存：{digest[:12]}")
+            return cached
+        # 同一张图片的并发识别只调用一次OCR接口；共享的识别不受某个请求的截止时间限制，
+        # 每个请求只按自己的剩余时间等待
+        wait = deadline.timeout() if deadline is not None else None
+        flight = self._flights.do(("ocr", digest), lambda: self._ocr_and_cache(image_url, data, digest))
+        return await asyncio.wait_for(flight, wait)
+
+    async def _ocr_and_cache(self, image_url: str, data: bytes, digest: str) -> str:
+        start = time.monotonic()
+        text = await self._recognize(image_url, data)
+        if text:
+            self.ocr_cache.set(digest, text, time.monotonic() - start)
+        return text
+
+    def _select_ocr_backends(self, image_data: bytes = None) -> list:
+        """按OCR_BACKEND策略返回依次尝试的OCR后端"""
+        local_ok = self.local_ocr.available(image_data)
+        if OCR_BACKEND == "local":
+            # 只使用本地引擎时不回退到网络OCR服务
+            if not local_ok:
+                reason = "未安装rapidocr_onnxruntime" if RapidOCR is None else "图片下载失败"
+                raise OcrError(f"本地OCR引擎不可用（{reason}）")
+            return [self.local_ocr]
+        if OCR_BACKEND == "remote" or not local_ok:
+            return [self.remote_ocr]
+        if len(image_data) <= OCR_LOCAL_MAX_BYTES:
+            return [self.local_ocr, self.remote_ocr]
+        return [self.remote_ocr, self.local_ocr]
+
+    async def _recognize(self, image_url: str, image_data: bytes = None, deadline: Deadline = None) -> str:
+        """依次尝试选中的OCR后端，前一个失败或未识别出文字时换下一个，剩余时间不足时不再尝试"""
+        last_error = None
+        recognized_empty = False
+        for backend in self._select_ocr_backends(image_data):
+            if deadline is not None and deadline.remaining() <= 0:
+                raise DeadlineExceededError("文字识别")
+            try:
+                text = await backend.recognize(image_url, image_data, deadline)
+            except DeadlineExceededError:
+                raise
+            except Exception as e:
+                logger.warning(f"OCR后端（{backend.name}）识别失败：{e}")
+                last_error = e
+                continue
+            if text:
+                self._ocr_backend_wins[backend.name] = self._ocr_backend_wins.get(backend.name, 0) + 1
+                return text
+            logger.info(f"OCR后端（{backend.name}）未识别出文字")
+            recognized_empty = True
+        if recognized_empty or last_error is None:
+            return ""
+        raise last_error
+
+    async def _ocr_request(self, image_url: str, image_data: bytes = None, deadline: Deadline = None) -> str:
+        """调用OCR接口识别图片，有图片内容时先在进程池中缩小压缩再以base64发送，否则发送图片URL
+
+        OCR接口不接受图片内容而改用URL成功时，之后的请求都直接发送URL。
+        """
+        start = time.monotonic()
+        if image_data is not None and OCR_SEND_BYTES and self._ocr_accepts_bytes:
+            try:
+                prepared = await self._run_in_process(prepare_ocr_image, image_data)
+            except Exception as e:
+                logger.warning(f"图片预处理失败，改为发送图片URL：{e}")
+            else:
+                logger.debug(f"OCR图片预处理：{len(image_data)}字节 -> {len(prepared)}字节")
+                try:
+                    text = await self._ocr_post(base64.b64encode(prepared).decode("ascii"), image_url, deadline)
+                    self._ocr_latency["上传图片"].record(time.monotonic() - start)
+                    return text
+                except OcrError as e:
+                    logger.warning(f"OCR接口未能处理图片内容，改为发送图片URL：{e}")
+                    text = await self._ocr_post(image_url, image_url, deadline)
+                    self._ocr_accepts_bytes = False
+                    return text
+        text = await self._ocr_post(image_url, image_url, deadline)
+        self._ocr_latency["图片链接"].record(time.monotonic() - start)
+        return text
+
+    async def _ocr_post(self, file: str, image_url: str, deadline: Deadline = None) -> str:
+        """调用OCR API识别图片中的文字，file为图片URL或base64编码的图片内容
+
+        相同的并发请求会合并为一次，合并后的请求始终使用OCR_TIMEOUT，
+        deadline只限制本次调用的等待时间，不会截短其他等待者共享的请求。
+        """
+        wait = deadline.timeout(OCR_TIMEOUT) if deadline is not None else None
         try:
             ocr_url = "https://api.pearktrue.cn/api/ocr/"
             payload = {
-                "file": image_url
+                "file": file
             }
             
             logger.debug(f"OCR识别请求：图片URL = {image_url}")
             logger.debug(f"OCR API URL = {ocr_url}")
-            logger.debug(f"请求参数 = {payload}")
             
-            # 增加超时时间到120秒
-            timeout = aiohttp.ClientTimeout(total=120)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                try:
-                    async with session.post(ocr_url, json=payload) as resp:
-                        logger.debug(f"OCR API响应状态码：{resp.status}")
-                        logger.debug(f"响应头：{resp.headers}")
-                        
-                        if resp.status != 200:
-                            resp_text = await resp.text()
-                            logger.error(f"OCR API请求失败，状态码：{resp.status}，响应内容：{resp_text}")
-                            raise Exception(f"OCR API请求失败，状态码：{resp.status}，响应：{resp_text[:100]}...")
-                        
-                        # 先读取响应文本，记录日志
-                        resp_text = await resp.text()
-                        logger.debug(f"OCR API响应内容：{resp_text}")
-                        
-                        try:
-                            result = json.loads(resp_text)
-                        except json.JSONDecodeError as json_error:
-                            logger.error(f"OCR API返回JSON格式错误：{str(json_error)}，响应内容：{resp_text}")
-                            raise Exception(f"OCR API返回JSON格式错误：{str(json_error)}")
-                        
-                        if result.get("code") != 200:
-                            logger.error(f"OCR识别失败：{result.get('msg', '未知错误')}")
-                            raise Exception(f"OCR识别失败：{result.get('msg', '未知错误')}")
-                        
-                        # 获取识别结果
-                        parsed_text = result.get("data", {}).get("ParsedText", "")
-                        if not parsed_text:
-                            # 如果ParsedText为空，尝试从TextLine拼接
-                            text_lines = result.get("data", {}).get("TextLine", [])
-                            parsed_text = "\n".join(text_lines)
-                        
-                        logger.debug(f"OCR识别成功，识别结果：{parsed_text[:100]}...")
-                        return parsed_text.strip()
-                except asyncio.TimeoutError:
-                    logger.error(f"OCR API请求超时，图片URL：{image_url}")
-                    raise Exception("OCR识别超时，请稍后重试")
-                except aiohttp.ClientError as client_error:
-                    logger.error(f"OCR API网络请求错误：{str(client_error)}，图片URL：{image_url}")
-                    raise Exception(f"OCR识别网络错误：{str(client_error)}")
+            try:
+                resp_text = await asyncio.wait_for(
+                    self._http_request("POST", ocr_url, json_body=payload, timeout=OCR_TIMEOUT), wait
+                )
+            except UpstreamStatusError as status_error:
+                logger.error(f"OCR API请求失败，状态码：{status_error.status}，响应内容：{status_error.body}")
+                message = f"OCR API请求失败，状态码：{status_error.status}，响应：{status_error.body[:100]}..."
+                if 400 <= status_error.status < 500:
+                    raise OcrError(message)
+                raise Exception(message)
+            except BulkheadFullError:
+                logger.warning("OCR服务排队已满，拒绝本次请求")
+                raise Exception("OCR服务繁忙，请稍后重试")
+            except CircuitOpenError as circuit_error:
+                raise Exception(f"OCR{circuit_error}")
+            except asyncio.TimeoutError:
+                logger.error(f"OCR API请求超时，图片URL：{image_url}")
+                raise Exception("OCR识别超时，请稍后重试")
+            except aiohttp.ClientError as client_error:
+                logger.error(f"OCR API网络请求错误：{str(client_error)}，图片URL：{image_url}")
+                raise Exception(f"OCR识别网络错误：{str(client_error)}")
+            
+            logger.debug(f"OCR API响应内容：{resp_text}")
+            
+            try:
+                result = json.loads(resp_text)
+            except json.JSONDecodeError as json_error:
+                logger.error(f"OCR API返回JSON格式错误：{str(json_error)}，响应内容：{resp_text}")
+                raise OcrError(f"OCR API返回JSON格式错误：{str(json_error)}")
+            
+            if result.get("code") != 200:
+                logger.error(f"OCR识别失败：{result.get('msg', '未知错误')}")
+                raise OcrError(f"OCR识别失败：{result.get('msg', '未知错误')}")
+            
+            # 获取识别结果
+            parsed_text = result.get("data", {}).get("ParsedText", "")
+            if not parsed_text:
+                # 如果ParsedText为空，尝试从TextLine拼接
+                text_lines = result.get("data", {}).get("TextLine", [])
+                parsed_text = "\n".join(text_lines)
+            
+            logger.debug(f"OCR识别成功，识别结果：{parsed_text[:100]}...")
+            return parsed_text.strip()
         except Exception as e:
             logger.error(f"OCR识别出错: {str(e)}")
             logger.exception("OCR识别异常详情")
             raise
+
+    async def _call_solver(self, question: str, deadline: Deadline = None):
+        """调用万能解题助手API，返回（思考过程，答案，时间）
+
+        传入deadline时为图片生成预留RENDER_RESERVE秒，剩余时间不足SOLVER_MIN_BUDGET秒时直接超时。
+        合并后的请求始终使用SOLVER_TIMEOUT，deadline只限制本次调用的等待时间。
+        """
+        api_url = "https://api.jkyai.top/API/wnjtzs.php"
+        params = {
+            "question": question,
+            "type": "json"  # 返回json格式，便于解析
+        }
+        
+        wait = None
+        if deadline is not None:
+            wait = deadline.timeout(SOLVER_TIMEOUT, minimum=SOLVER_MIN_BUDGET, reserve=RENDER_RESERVE)
+        text = await asyncio.wait_for(
+            self._http_request("GET", api_url, params=params, timeout=SOLVER_TIMEOUT, policy=SOLVER_POLICY), wait
+        )
+        try:
+            result = json.loads(text)
+        except json.JSONDecodeError:
+            raise SolverError(f"解题助手返回格式错误，预期JSON但得到：{text[:100]}...")
+        
+        # 解析API返回结果
+        status = result.get("status", "")
+        if status != "success":
+            error_msg = result.get("answer", "解题助手请求失败")
+            raise SolverError(f"解题助手请求失败：{error_msg}")
+        
+        # 获取data字段
+        data = result.get("data", {})
+        answer = data.get("answer", "")
+        
+        # 获取created_at
+        metadata = data.get("metadata", {})
+        created_at = metadata.get("created_at", "")
+        
+        thinking, answer_content = split_solver_answer(answer)
+        return thinking, answer_content, created_at
             
-    async def process_image_question_solving(self, event: AstrMessageEvent, image_url: str):
-        """处理图片解题的完整流程"""
+    async def _run_stage(self, stage: str, item, on_queued=None, deadline: Deadline = None):
+        """把任务提交到解题流水线的指定阶段并等待结果，传入deadline时排队和执行都不超过剩余时间"""
+        run = self._pipeline[stage].run(item, on_queued)
+        if deadline is None:
+            return await run
+        return await deadline.run(self._pipeline[stage].name, run)
+
+    async def _ocr_question(self, image_url: str, on_queued=None, deadline: Deadline = None) -> str:
+        """经过流水线的下载和识别阶段识别图片中的题目，失败时抛出ImageSolveError"""
+        try:
+            data = await self._run_stage("fetch", (image_url, deadline), on_queued, deadline)
+            question_text = await self._run_stage("ocr", (image_url, data, deadline), on_queued, deadline)
+        except BulkheadFullError:
+            raise ImageSolveError(BUSY_MESSAGE)
+        except asyncio.TimeoutError as e:
+            if deadline is not None and isinstance(e, DeadlineExceededError):
+                deadline.log_timeout("文字识别")
+            raise ImageSolveError("OCR识别超时，服务器响应过慢\n\n建议：\n1. 检查网络连接\n2. 确保图片清晰可辨\n3. 稍后重试")
+        except Exception as ocr_error:
+            raise ImageSolveError(f"OCR识别失败：{str(ocr_error)}\n\n建议：\n1. 检查网络连接\n2. 确保图片清晰可辨\n3. 稍后重试")
+        if not question_text:
+            raise ImageSolveError("OCR识别失败，未能从图片中提取到题目内容")
+        return question_text
+
+    async def _solve_question(self, question: str, on_queued=None, deadline: Deadline = None) -> str:
+        """经过流水线的解题阶段调用解题助手，整理为用于生成图片的文本，失败时抛出ImageSolveError"""
+        try:
+            thinking, answer_content, created_at = await self._run_stage("solve", (question, deadline), on_queued, deadline)
+        except Exception as e:
+            if deadline is not None and isinstance(e, DeadlineExceededError):
+                deadline.log_timeout("解题")
+            message = solver_error_message(e)
+            if message is None:
+                raise
+            raise ImageSolveError(message) from e
+        return format_solution(question, thinking, answer_content, created_at)
+
+    async def _render_solution(self, formatted_content: str, on_queued=None, deadline: Deadline = None) -> list:
+        """经过流水线的图片生成阶段渲染解题结果"""
+        return await self._run_stage("render", (formatted_content, deadline), on_queued, deadline)
+
+    async def _solve_images(self, image_urls: list, on_queued=None, deadline: Deadline = None) -> list:
+        """并发识别并解答多张图片，同一请求中同时进行的数量不超过IMAGE_SOLVE_PARALLELISM
+
+        按原顺序返回每张图片的解题文本，失败的图片对应位置为异常对象。
+        """
+        semaphore = asyncio.Semaphore(IMAGE_SOLVE_PARALLELISM)
+        
+        async def solve(image_url):
+            async with semaphore:
+                question = await self._ocr_question(image_url, on_queued, deadline)
+                return await self._solve_question(question, on_queued, deadline)
+        
+        return await asyncio.gather(*(solve(image_url) for image_url in image_urls), return_exceptions=True)
+
+    async def process_image_question_solving(self, event: AstrMessageEvent, image_urls: list):
+        """处理图片解题的完整流程：经过流水线的下载、识别、解题、图片生成阶段
+
+        多张图片时并发解题并按原顺序汇总结果，所有阶段共用SOLVE_BUDGET秒的截止时间。
+        """
+        deadline = Deadline("图片解题", SOLVE_BUDGET)
+        self._jobs_in_flight += 1
+        try:
+            if len(image_urls) > 1:
+                results = self._process_multi_image_solving(event, image_urls, deadline)
+            else:
+                results = self._process_single_image_solving(event, image_urls[0], deadline)
+            async for result in results:
+                yield result
+        finally:
+            self._jobs_in_flight -= 1
+
+    async def _process_single_image_solving(self, event: AstrMessageEvent, image_url: str, deadline: Deadline):
+        """单张图片解题，每个阶段开始前提示用户"""
+        on_queued = pipeline_queue_notifier(event)
         try:
             # 1. 调用OCR识别图片中的题目
             yield CommandResult().message("正在识别图片中的题目，请稍候...")
             try:
-                question_text = await self.ocr_recognize(image_url)
-            except asyncio.TimeoutError:
-                yield CommandResult().error("OCR识别超时，服务器响应过慢\n\n建议：\n1. 检查网络连接\n2. 确保图片清晰可辨\n3. 稍后重试")
-                return
-            except Exception as ocr_error:
-                yield CommandResult().error(f"OCR识别失败：{str(ocr_error)}\n\n建议：\n1. 检查网络连接\n2. 确保图片清晰可辨\n3. 稍后重试")
-                return
-            
-            if not question_text:
-                yield CommandResult().error("OCR识别失败，未能从图片中提取到题目内容")
+                question_text = await self._ocr_question(image_url, on_queued, deadline)
+            except ImageSolveError as e:
+                yield CommandResult().error(str(e))
                 return
             
             # 2. 调用万能解题助手API
             yield CommandResult().message("正在解题，请稍候...")
-            api_url = "https://api.jkyai.top/API/wnjtzs.php"
-            params = {
-                "question": question_text,
-                "type": "json"  # 返回json格式，便于解析
-            }
+            try:
+                formatted_content = await self._solve_question(question_text, on_queued, deadline)
+            except ImageSolveError as e:
+                yield CommandResult().error(str(e))
+                return
             
-            timeout = aiohttp.ClientTimeout(total=120)  # 延长超时时间到120秒
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                try:
-                    async with session.get(api_url, params=params) as resp:
-                        if resp.status != 200:
-                            yield CommandResult().error(f"解题助手请求失败，服务器返回错误状态码：{resp.status}")
-                            return
-                        
-                        # 检查响应头的Content-Type
-                        content_type = resp.headers.get('Content-Type', '')
-                        if 'application/json' not in content_type:
-                            # 如果不是json，先尝试读取文本内容
-                            text_content = await resp.text()
-                            yield CommandResult().error(f"解题助手返回格式错误，预期JSON但得到：{text_content[:100]}...")
-                            return
-                        
-                        try:
-                            result = await resp.json()
-                        except json.JSONDecodeError as e:
-                            yield CommandResult().error(f"解题助手返回JSON格式错误：{str(e)}")
-                            return
-                        
-                        # 3. 解析API返回结果
-                        status = result.get("status", "")
-                        if status != "success":
-                            error_msg = result.get("answer", "解题助手请求失败")
-                            yield CommandResult().error(f"解题助手请求失败：{error_msg}")
-                            return
-                        
-                        # 获取data字段
-                        data = result.get("data", {})
-                        answer = data.get("answer", "")
-                        
-                        # 获取created_at
-                        metadata = data.get("metadata", {})
-                        created_at = metadata.get("created_at", "")
-                        
-                        # 4. 提取思考过程和答案
-                        # 从answer中提取思考过程和答案
-                        # answer格式：<Think>思考内容</Think>【解题答案：答案内容】
-                        think_start = answer.find("<Think>")
-                        think_end = answer.find("</Think>")
-                        if think_start != -1 and think_end != -1:
-                            thinking = answer[think_start+6:think_end].strip()
-                            answer_content = answer[think_end+8:].strip()
-                            # 移除可能的【解题答案：】前缀
-                            if answer_content.startswith("【解题答案："):
-                                answer_content = answer_content[7:].strip()
-                                if answer_content.endswith("】"):
-                                    answer_content = answer_content[:-1].strip()
-                        else:
-                            # 如果没有<Think>标签，直接使用answer作为答案
-                            thinking = ""  # 没有思考过程
-                            answer_content = answer.strip()
-                        
-                        # 5. 格式化内容
-                        formatted_content = f"题目：\n{question_text}\n\n思考过程：\n{thinking}\n\n答案：\n{answer_content}\n\n时间：\n{created_at}"
-                        
-                        # 6. 生成图片
-                        try:
-                            # 返回处理中的提示
-                            yield CommandResult().message("正在生成图片，请稍候...")
-                            
-                            image_url = await self.text_to_image_menu_style(formatted_content)
-                            yield event.image_result(image_url)
-                        except Exception as img_error:
-                            logger.error(f"生成图片失败：{img_error}")
-                            # 详细记录错误信息
-                            logger.exception("生成图片时发生异常")
-                            # 如果生成图片失败，直接返回文本格式
-                            yield CommandResult().message(f"图片生成失败，以下是文本答案：\n\n{formatted_content}")
-                except asyncio.TimeoutError:
-                    yield CommandResult().error("解题助手请求超时，服务器响应过慢\n\n建议：\n1. 检查网络连接\n2. 稍后重试")
-                    return
-                except aiohttp.ClientError as client_error:
-                    yield CommandResult().error(f"解题助手网络请求失败：{str(client_error)}\n\n建议：\n1. 检查网络连接\n2. 稍后重试")
-                    return
+            # 3. 生成图片
+            try:
+                # 返回处理中的提示
+                yield CommandResult().message("正在生成图片，请稍候...")
+                
+                image_paths = await self._render_solution(formatted_content, on_queued, deadline)
+                yield image_reply(event, image_paths)
+            except Exception as img_error:
+                logger.error(f"生成图片失败：{img_error}")
+                # 详细记录错误信息
+                logger.exception("生成图片时发生异常")
+                # 如果生成图片失败，直接返回文本格式
+                yield CommandResult().message(f"图片生成失败，以下是文本答案：\n\n{formatted_content}")
                         
         except Exception as e:
             logger.error(f"图片解题失败：{str(e)}")
             logger.exception("图片解题异常详情")
             # 增加更友好的错误提示
             yield CommandResult().error(f"图片解题失败：{str(e)}\n\n可能的原因：\n1. 图片链接不可访问\n2. 图片中没有可识别的文字\n3. 网络连接问题\n4. 服务器暂时不可用\n\n请检查图片是否清晰可辨，或稍后重试")
-    
+
+    async def _process_multi_image_solving(self, event: AstrMessageEvent, image_urls: list, deadline: Deadline):
+        """多张图片并发解题，结果合并为一张答题卡或每题一张图片"""
+        if len(image_urls) > IMAGE_SOLVE_MAX_IMAGES:
+            yield CommandResult().message(f"一次最多处理{IMAGE_SOLVE_MAX_IMAGES}张图片，只处理前{IMAGE_SOLVE_MAX_IMAGES}张")
+            image_urls = image_urls[:IMAGE_SOLVE_MAX_IMAGES]
+        
+        yield CommandResult().message(f"共{len(image_urls)}张图片，正在识别题目并解题，请稍候...")
+        on_queued = pipeline_queue_notifier(event)
+        results = await self._solve_images(image_urls, on_queued, deadline)
+        
+        sections = []
+        failures = 0
+        for index, result in enumerate(results, 1):
+            if isinstance(result, ImageSolveError):
+                failures += 1
+                sections.append((f"【第{index}张图片】\n{result}", False))
+            elif isinstance(result, BaseException):
+                logger.error(f"第{index}张图片解题失败：{result}")
+                failures += 1
+                sections.append((f"【第{index}张图片】\n图片解题失败：{str(result)}", False))
+            else:
+                sections.append((f"【第{index}张图片】\n{result}", True))
+        
+        if failures == len(sections):
+            yield CommandResult().error("所有图片都解题失败：\n\n" + "\n\n".join(text for text, _ in sections))
+            return
+        
+        yield CommandResult().message("正在生成图片，请稍候...")
+        if IMAGE_SOLVE_LAYOUT == "separate":
+            # 每题一张图片，失败的图片直接以文字说明
+            outputs = sections
+        else:
+            outputs = [("\n\n".join(text for text, _ in sections), True)]
+        renders = iter(await asyncio.gather(
+            *(self._render_solution(text, on_queued, deadline) for text, solved in outputs if solved),
+            return_exceptions=True,
+        ))
+        for text, solved in outputs:
+            if not solved:
+                yield CommandResult().error(text)
+                continue
+            image_paths = next(renders)
+            if isinstance(image_paths, BaseException):
+                logger.error(f"生成图片失败：{image_paths}")
+                yield CommandResult().message(f"图片生成失败，以下是文本答案：\n\n{text}")
+            else:
+                yield image_reply(event, image_paths)
+
     # 菜单样式的HTML模板
     MENU_TEMPLATE = '''
     <!DOCTYPE html>
@@ -1107,91 +3219,188 @@ class Main(Star):
     </html>
     '''
     
-    async def text_to_image_menu_style(self, text: str) -> str:
-        """使用菜单样式的HTML模板生成图片"""
-        try:
-            # 将文本内容转换为结构化HTML
-            lines = text.split('\n')
-            html_parts = []
-            current_section = ""
-            
-            for line in lines:
-                line = line.rstrip()
-                
-                # 检测是否为大模型菜单
-                if line == "大模型菜单":
-                    # 大模型菜单标题已在模板中处理
-                    continue
-                
-                # 检测分类标题
-                elif line.startswith('一、') or line.startswith('二、') or line.startswith('三、') or line.startswith('四、'):
-                    category_name = line.split('、')[1]
-                    html_parts.append(f'<h2 class="category-title">{category_name}</h2>')
-                    continue
-                
-                # 检测模型条目
-                elif ' - ' in line:
-                    # 解析模型条目
-                    model_part, desc_part = line.split(' - ', 1)
-                    
-                    # 检测是否包含示例格式
-                    if '<提问内容>' in model_part or '<6位数字>' in model_part or '<图片>' in model_part or '<题目内容>' in model_part:
-                        # 这是一个模型命令格式
-                        model_format = model_part.strip()
-                        model_desc = desc_part.strip()
-                        
-                        # 提取模型名称
-                        if ' ' in model_format:
-                            model_name = model_format.split(' ')[0]
-                        else:
-                            model_name = model_format
-                        
-                        # 生成示例
-                        example = model_format.replace('<提问内容>', '1+1').replace('<6位数字>', '123456').replace('<图片>', '[图片]').replace('<题目内容>', '1+1')
-                        
-                        # 生成HTML
-                        html_parts.append(f'<div class="model-item">')
-                        html_parts.append(f'<span class="model-name">{model_name}</span> ')
-                        html_parts.append(f'<span class="model-format">{model_format}</span> ')
-                        html_parts.append(f'<span class="separator">---------------</span> ')
-                        html_parts.append(f'<span class="example">示例：{example}（注意有空格）</span> ')
-                        html_parts.append(f'<span class="separator">----------</span> ')
-                        html_parts.append(f'<span class="model-desc">{model_desc}</span>')
-                        html_parts.append(f'</div>')
-                
-                # 处理空行
-                elif line.strip() == '':
-                    continue
-                
-                # 处理其他文本行
-                else:
-                    html_parts.append(f'<div class="content-line">{line}</div>')
-            
-            # 组装最终HTML内容
-            formatted_html = '\n'.join(html_parts)
+    def _build_menu_html(self, text: str) -> str:
+        """把菜单样式的文本转换为完整的HTML页面"""
+        # 将文本内容转换为结构化HTML
+        html_parts = []
+        for block in parse_card_blocks(text):
+            kind = block[0]
             
-            # 渲染HTML模板
-            html_content = self.MENU_TEMPLATE.replace("{{content}}", formatted_html)
+            # 分类标题
+            if kind == "category":
+                html_parts.append(f'<h2 class="category-title">{block[1]}</h2>')
             
-            # 使用html_render函数生成图片
-            options = {
-                "full_page": True,
-                "type": "jpeg",
-                "quality": 95,
-            }
-            
-            image_url = await self.html_render(
-                html_content,  # 渲染后的HTML内容
-                {},  # 空数据字典
-                True,  # 返回URL
-                options  # 图片生成选项
-            )
+            # 模型条目
+            elif kind == "model":
+                _, model_name, model_format, example, model_desc = block
+                html_parts.append(f'<div class="model-item">')
+                html_parts.append(f'<span class="model-name">{model_name}</span> ')
+                html_parts.append(f'<span class="model-format">{model_format}</span> ')
+                html_parts.append(f'<span class="separator">---------------</span> ')
+                html_parts.append(f'<span class="example">示例：{example}（注意有空格）</span> ')
+                html_parts.append(f'<span class="separator">----------</span> ')
+                html_parts.append(f'<span class="model-desc">{model_desc}</span>')
+                html_parts.append(f'</div>')
             
-            return image_url
+            # 其他文本行
+            else:
+                html_parts.append(f'<div class="content-line">{block[1]}</div>')
+        
+        # 组装最终HTML内容
+        formatted_html = '\n'.join(html_parts)
+        
+        # 渲染HTML模板
+        return self.MENU_TEMPLATE.replace("{{content}}", formatted_html)
+
+    async def _encode_render(self, data: bytes) -> list:
+        """把渲染结果编码到字节预算内，返回各页图片的字节内容"""
+        start = time.monotonic()
+        try:
+            pages = await asyncio.to_thread(encode_image, data)
+        except Exception as e:
+            # 编码失败时直接使用原图
+            logger.warning(f"图片编码失败，使用原始渲染结果：{e}")
+            self.encode_stats.failures += 1
+            return [data]
+        elapsed = time.monotonic() - start
+        encoded = sum(len(page) for page in pages)
+        self.encode_stats.record(len(data), encoded, len(pages), elapsed)
+        logger.info(
+            f"图片编码：{len(data)}字节 -> {encoded}字节（节省{len(data) - encoded}字节），"
+            f"{len(pages)}页，耗时{elapsed:.3f}秒"
+        )
+        return pages
+
+    async def _render_html(self, html_content: str) -> list:
+        """把HTML渲染为图片并返回各页的本地路径，相同的HTML直接复用渲染缓存
+
+        并发由调用方限制：解题结果经过流水线的图片生成阶段，菜单图片经过菜单渲染调度。
+        """
+        key = hashlib.sha256((html_content + flight_key(RENDER_OPTIONS) + encoding_signature()).encode("utf-8")).hexdigest()
+        cached = self.render_cache.get(key)
+        if cached:
+            logger.debug("命中渲染缓存，跳过页面渲染")
+            return cached
+        
+        start = time.monotonic()
+        # 使用html_render函数生成图片
+        image_path = await self.html_render(
+            html_content,  # 渲染后的HTML内容
+            {},  # 空数据字典
+            False,  # 返回本地文件路径，便于缓存图片内容
+            RENDER_OPTIONS  # 图片生成选项
+        )
+        self._render_latency.record(time.monotonic() - start)
+        with open(image_path, "rb") as f:
+            data = f.read()
+        return self.render_cache.put(key, await self._encode_render(data))
+
+    async def _run_in_process(self, func, *args, pool: str = "shared"):
+        """在进程池中执行CPU密集的函数，进程池不可用时改为在线程中执行
+
+        本地OCR使用单独的"ocr"进程池，长时间的识别不会占满共享进程池而阻塞本地绘制和图片预处理。
+        """
+        try:
+            executor = self._process_pools.get(pool)
+            if executor is None:
+                workers = OCR_LOCAL_CONCURRENCY if pool == "ocr" else PROCESS_POOL_WORKERS
+                executor = self._process_pools[pool] = ProcessPoolExecutor(max_workers=workers)
+            return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+        except (BrokenProcessPool, OSError, pickle.PicklingError) as e:
+            # 运行环境禁止创建子进程等情况下，改为在线程中执行
+            logger.warning(f"进程池不可用，改为在线程中执行：{e}")
+            executor = self._process_pools.pop(pool, None)
+            if executor is not None:
+                executor.shutdown(wait=False)
+            return await asyncio.to_thread(func, *args)
+
+    def _local_render_enabled(self) -> bool:
+        """是否可以使用本地绘制（已安装Pillow并找到中文字体）"""
+        return RENDER_ENGINE != "html" and self._local_fonts[0] is not None
+
+    async def _render_local(self, text: str) -> list:
+        """用Pillow在进程池中绘制菜单样式的卡片图片，返回各页的本地路径"""
+        blocks = parse_card_blocks(text)
+        font_path, bold_font_path = self._local_fonts
+        payload = json.dumps([LOCAL_RENDER_VERSION, font_path, bold_font_path, blocks], ensure_ascii=False)
+        key = hashlib.sha256(("local" + payload + encoding_signature()).encode("utf-8")).hexdigest()
+        cached = self.render_cache.get(key)
+        if cached:
+            logger.debug("命中渲染缓存，跳过本地绘制")
+            return cached
+        
+        start = time.monotonic()
+        data = await self._run_in_process(render_card_image, blocks, font_path, bold_font_path)
+        self._local_render_latency.record(time.monotonic() - start)
+        return self.render_cache.put(key, await self._encode_render(data))
+
+    async def _render_card(self, text: str) -> list:
+        """把菜单样式的文本渲染为图片，优先本地绘制，失败时回退到HTML渲染"""
+        if self._local_render_enabled():
+            try:
+                return await self._render_local(text)
+            except Exception as e:
+                logger.warning(f"本地绘制失败，回退到HTML渲染：{e}")
+        return await self._render_html(self._build_menu_html(text))
+
+    async def text_to_image_menu_style(self, text: str, deadline: Deadline = None) -> list:
+        """使用菜单样式的HTML模板生成图片，返回各页图片的路径列表"""
+        try:
+            return await self._render_card(text)
         except Exception as e:
+            if deadline is not None and deadline.remaining() <= 0:
+                raise DeadlineExceededError("图片生成") from e
             logger.error(f"菜单样式图片生成失败：{e}")
             # 回退到默认的text_to_image方法
-            return await self.text_to_image(text)
+            return [await self.text_to_image(text)]
+
+    def _menu_key(self, menu_content: str) -> str:
+        """菜单图片的缓存键：菜单文本和HTML模板的内容哈希"""
+        return hashlib.sha256((menu_content + self.MENU_TEMPLATE).encode("utf-8")).hexdigest()
+
+    def _cached_menu_image(self, menu_content: str):
+        """返回仍然有效的菜单图片，菜单文本或模板变化后自动失效"""
+        if self._menu_image is None:
+            return None
+        key, image_urls = self._menu_image
+        if key != self._menu_key(menu_content) or not all(image_available(url) for url in image_urls):
+            return None
+        return image_urls
+
+    async def _get_menu_image(self, menu_content: str, fallback: bool = True) -> list:
+        """获取大模型菜单图片，只在首次使用或内容变化时渲染一次
+
+        渲染失败时回退到text_to_image；fallback为False时直接抛出异常（用于预渲染，回退结果不会被使用）。
+        """
+        image_urls = self._cached_menu_image(menu_content)
+        if image_urls:
+            return image_urls
+        async with self._menu_lock:
+            # 等待锁期间可能已经由其他请求渲染完成
+            image_urls = self._cached_menu_image(menu_content)
+            if image_urls:
+                return image_urls
+            try:
+                async with self._render_slots.acquire():
+                    image_urls = await self._render_card(menu_content)
+            except BulkheadFullError:
+                raise
+            except Exception as e:
+                if not fallback:
+                    raise
+                logger.error(f"菜单样式图片生成失败：{e}")
+                # 回退到默认的text_to_image方法，回退结果不缓存
+                return [await self.text_to_image(menu_content)]
+            self._menu_image = (self._menu_key(menu_content), image_urls)
+            logger.info("大模型菜单图片已渲染并缓存")
+            return image_urls
+
+    async def _warm_up_menu(self):
+        """插件加载后预先渲染大模型菜单图片"""
+        try:
+            await self._get_menu_image(build_model_menu(), fallback=False)
+        except Exception as e:
+            logger.warning(f"预渲染大模型菜单图片失败，将在首次使用时重试：{e}")
     
     @filter.command("解题助手")
     async def jie_ti_zhu_shou(self, message: AstrMessageEvent):
@@ -1203,172 +3412,70 @@ class Main(Star):
             return
         
         question = msg.strip()
+        on_queued = pipeline_queue_notifier(message)
+        deadline = Deadline("解题助手", SOLVE_BUDGET)
         
+        self._jobs_in_flight += 1
         try:
-            # 1. 调用万能解题助手API
-            api_url = "https://api.jkyai.top/API/wnjtzs.php"
-            params = {
-                "question": question,
-                "type": "json"  # 返回json格式，便于解析
-            }
+            # 1. 经过流水线的解题阶段调用万能解题助手API
+            try:
+                formatted_content = await self._solve_question(question, on_queued, deadline)
+            except ImageSolveError as e:
+                yield CommandResult().error(str(e))
+                return
             
-            timeout = aiohttp.ClientTimeout(total=120)  # 延长超时时间到120秒
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(api_url, params=params) as resp:
-                    if resp.status != 200:
-                        yield CommandResult().error(f"解题助手请求失败，服务器返回错误状态码：{resp.status}")
-                        return
-                    
-                    # 检查响应头的Content-Type
-                    content_type = resp.headers.get('Content-Type', '')
-                    if 'application/json' not in content_type:
-                        # 如果不是json，先尝试读取文本内容
-                        text_content = await resp.text()
-                        yield CommandResult().error(f"解题助手返回格式错误，预期JSON但得到：{text_content[:100]}...")
-                        return
-                    
-                    try:
-                        result = await resp.json()
-                    except json.JSONDecodeError as e:
-                        yield CommandResult().error(f"解题助手返回JSON格式错误：{str(e)}")
-                        return
-                    
-                    # 2. 解析API返回结果
-                    status = result.get("status", "")
-                    if status != "success":
-                        error_msg = result.get("answer", "解题助手请求失败")
-                        yield CommandResult().error(f"解题助手请求失败：{error_msg}")
-                        return
-                    
-                    # 获取data字段
-                    data = result.get("data", {})
-                    answer = data.get("answer", "")
-                    
-                    # 获取created_at
-                    metadata = data.get("metadata", {})
-                    created_at = metadata.get("created_at", "")
-                    
-                    # 3. 提取思考过程和答案
-                    # 从answer中提取思考过程和答案
-                    # answer格式：<Think>思考内容</Think>【解题答案：答案内容】
-                    think_start = answer.find("<Think>")
-                    think_end = answer.find("</Think>")
-                    if think_start != -1 and think_end != -1:
-                        thinking = answer[think_start+6:think_end].strip()
-                        answer_content = answer[think_end+8:].strip()
-                        # 移除可能的【解题答案：】前缀
-                        if answer_content.startswith("【解题答案："):
-                            answer_content = answer_content[7:].strip()
-                            if answer_content.endswith("】"):
-                                answer_content = answer_content[:-1].strip()
-                    else:
-                        # 如果没有<Think>标签，直接使用answer作为答案
-                        thinking = ""  # 没有思考过程
-                        answer_content = answer.strip()
-                    
-                    # 4. 格式化内容
-                    formatted_content = f"题目：\n{question}\n\n思考过程：\n{thinking}\n\n答案：\n{answer_content}\n\n时间：\n{created_at}"
-                    
-                    # 5. 生成图片
-                    try:
-                        # 先返回一个处理中的提示
-                        yield CommandResult().message("正在生成图片，请稍候...")
-                        
-                        image_url = await self.text_to_image_menu_style(formatted_content)
-                        yield message.image_result(image_url)
-                    except Exception as img_error:
-                        logger.error(f"生成图片失败：{img_error}")
-                        # 详细记录错误信息
-                        logger.exception("生成图片时发生异常")
-                        # 如果生成图片失败，直接返回文本格式
-                        yield CommandResult().message(f"图片生成失败，以下是文本答案：\n\n{formatted_content}")
+            # 2. 经过流水线的图片生成阶段生成图片
+            try:
+                # 先返回一个处理中的提示
+                yield CommandResult().message("正在生成图片，请稍候...")
+                
+                image_paths = await self._render_solution(formatted_content, on_queued, deadline)
+                yield image_reply(message, image_paths)
+            except Exception as img_error:
+                logger.error(f"生成图片失败：{img_error}")
+                # 详细记录错误信息
+                logger.exception("生成图片时发生异常")
+                # 如果生成图片失败，直接返回文本格式
+                yield CommandResult().message(f"图片生成失败，以下是文本答案：\n\n{formatted_content}")
                         
-        except aiohttp.ClientError as e:
-            logger.error(f"网络连接错误：{e}")
-            yield CommandResult().error("无法连接到解题助手服务器，请稍后重试")
-        except asyncio.TimeoutError:
-            logger.error("请求超时")
-            yield CommandResult().error("请求超时，请稍后重试")
         except Exception as e:
             logger.error(f"解题助手请求时发生错误：{e}")
             yield CommandResult().error(f"请求时发生错误：{str(e)}")
+        finally:
+            self._jobs_in_flight -= 1
     
     @filter.command("图片解题助手")
     async def tu_pian_jie_ti_zhu_shou(self, message: AstrMessageEvent):
         """图片解题助手，支持识别图片中的题目并解题，返回图片格式的解题结果"""
-        user_id = message.get_sender_id()
-        
         # 检查当前消息是否包含图片
-        image_url = await self.extract_image_from_event(message)
-        if image_url:
+        image_urls = await self.extract_images_from_event(message)
+        if image_urls:
             # 如果找到图片，直接进行处理
-            async for result in self.process_image_question_solving(message, image_url):
+            async for result in self.process_image_question_solving(message, image_urls):
                 yield result
             return
         
-        # 如果没有图片，设置等待状态
-        self.waiting_sessions[user_id] = {
-            "timestamp": asyncio.get_event_loop().time(),
-            "event": message  # 保存事件对象用于后续处理
-        }
-        
-        # 创建30秒超时任务
-        if user_id in self.timeout_tasks:
-            self.timeout_tasks[user_id].cancel()  # 取消之前的超时任务
-        
-        timeout_task = asyncio.create_task(self.timeout_check(user_id, message))
-        self.timeout_tasks[user_id] = timeout_task
+        # 如果没有图片，设置等待状态，重复发送命令时重新计时
+        self.waiting_sessions.add(message.unified_msg_origin, message.get_sender_id())
+        self.dispatcher.register(message.unified_msg_origin, message.get_sender_id(), self._on_waiting_image)
         
-        yield CommandResult().message("📷 请发送要识别的图片（30秒内有效）")
+        yield CommandResult().message(f"📷 请发送要识别的图片（{WAITING_TIMEOUT}秒内有效）")
     
     @filter.command("大模型菜单")
     async def da_mo_xing_cai_dan(self, message: AstrMessageEvent):
         """大模型菜单，显示所有可用的AI助手命令"""
         try:
-            # 构建菜单内容
-            menu_content = "大模型菜单\n\n"
-            
-            # 1. 单次问答模型
-            menu_content += "一、单次问答模型\n"
-            menu_content += "腾讯元宝 <提问内容> - 腾讯元宝助手\n"
-            menu_content += "deep3.2 <提问内容> - DeepSeek-3.2助手\n"
-            menu_content += "deep3.1 <提问内容> - DeepSeek-3.1助手\n"
-            menu_content += "deepR1 <提问内容> - DeepSeek-R1助手\n"
-            menu_content += "智谱 <提问内容> - 智谱GLM4.6助手\n"
-            menu_content += "夸克 <提问内容> - 夸克AI助手\n"
-            menu_content += "蚂蚁 <提问内容> - 蚂蚁Ling2.0-1tAI助手\n"
-            menu_content += "豆包 <提问内容> - 字节跳动豆包AI助手\n"
-            menu_content += "阿里 <提问内容> - 阿里云千问Qwen3-235bAI助手\n"
-            menu_content += "讯飞 <提问内容> - 讯飞星火X1AI助手\n"
-            menu_content += "\n"
-            
-            # 2. 记忆模型
-            menu_content += "二、记忆模型\n"
-            menu_content += "gpt5 <6位数字> <提问内容> - GPT5-nano助手\n"
-            menu_content += "克劳德 <6位数字> <提问内容> - Claude4.5-hiku助手\n"
-            menu_content += "千问 <6位数字> <提问内容> - 通义千问助手\n"
-            menu_content += "gpt <6位数字> <提问内容> - ChatGPT-ossAI助手\n"
-            menu_content += "谷歌 <6位数字> <提问内容> - 谷歌Gemini-2.5AI助手\n"
-            menu_content += "小米 <6位数字> <提问内容> - 小米MiMo-V2助手\n"
-            menu_content += "\n"
-            
-            # 3. 联网模式
-            menu_content += "三、联网模式\n"
-            menu_content += "联网模式 <提问内容> - 结合搜索引擎和DeepSeek-3.2AI进行问答\n"
-            menu_content += "\n"
-            
-            # 4. 解题模型
-            menu_content += "四、解题模型\n"
-            menu_content += "解题助手 <题目内容> - 调用万能解题助手，返回图片结果\n"
-            menu_content += "图片解题助手 <图片> - 识别图片中的题目并解题，返回图片结果\n"
+            # 根据注册表构建菜单内容
+            menu_content = build_model_menu()
             
             # 生成图片
             try:
-                # 返回处理中的提示
-                yield CommandResult().message("正在生成大模型菜单，请稍候...")
+                # 没有可用的缓存图片时返回处理中的提示
+                if not self._cached_menu_image(menu_content):
+                    yield CommandResult().message("正在生成大模型菜单，请稍候...")
                 
-                image_url = await self.text_to_image_menu_style(menu_content)
-                yield message.image_result(image_url)
+                image_urls = await self._get_menu_image(menu_content)
+                yield image_reply(message, image_urls)
             except Exception as img_error:
                 logger.error(f"生成大模型菜单图片失败：{img_error}")
                 logger.exception("生成大模型菜单图片时发生异常")
@@ -1379,29 +3486,188 @@ class Main(Star):
             logger.error(f"生成大模型菜单失败：{e}")
             yield CommandResult().error(f"生成大模型菜单失败：{str(e)}")
     
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("大模型状态")
+    async def da_mo_xing_zhuang_tai(self, message: AstrMessageEvent):
+        """查看回答缓存、请求合并、并发隔离和熔断等运行状态（仅管理员）"""
+        return CommandResult().message(self._status_text())
+
+    def _status_text(self) -> str:
+        """生成运行状态文本"""
+        lines = ["大模型运行状态", ""]
+        
+        cache = self.answer_cache.stats()
+        lines.append("【回答缓存】")
+        lines.append(f"条目：{cache['entries']}，占用：{cache['bytes']}字节，命中率：{cache['hit_rate']:.1%}（命中{cache['hits']}/未命中{cache['misses']}）")
+        lines.append(f"淘汰：{cache['evictions']}，过期：{cache['expirations']}")
+        lines.append("")
+
+        search = self.search_cache.stats()
+        lines.append("【联网搜索】")
+        lines.append(f"缓存条目：{search['entries']}，命中率：{search['hit_rate']:.1%}（命中{search['hits']}/未命中{search['misses']}）")
+        for name, (ok, failed, timed_out, returned) in self.search_stats.items():
+            lines.append(
+                f"{name}：成功{ok}，失败{failed}，超时{timed_out}，平均结果{returned / ok if ok else 0:.1f}条"
+            )
+        spec = self.speculation_stats
+        lines.append(
+            f"推测执行（{SEARCH_SPECULATIVE_MODE}）：{spec.runs}次，直接回答胜出{spec.direct_wins}，联网回答胜出{spec.search_wins}，"
+            f"失败{spec.failures}，未推测{spec.skipped}"
+        )
+        if spec.runs:
+            lines.append(
+                f"节省耗时：累计{spec.saved_seconds:.1f}秒（直接回答胜出时平均"
+                f"{spec.saved_seconds / spec.direct_wins if spec.direct_wins else 0:.1f}秒），"
+                f"额外上游请求：{spec.extra_requests}次（每次推测{spec.extra_requests / spec.runs:.2f}次）"
+            )
+        for label in sorted(self._search_latency, key=lambda label: (label[0] == ">", int(label[1:-1]))):
+            tracker = self._search_latency[label]
+            lines.append(
+                f"搜索信息{label}时回答耗时：P50 {tracker.percentile(0.5):.2f}秒，"
+                f"P95 {tracker.percentile(0.95):.2f}秒（{len(tracker)}次）"
+            )
+        lines.append("")
+
+        ocr = self.ocr_cache.stats()
+        lines.append("【OCR缓存】")
+        lines.append(
+            f"内存条目：{ocr['entries']}，命中率：{ocr['hit_rate']:.1%}（内存命中{ocr['memory_hits']}/磁盘命中{ocr['disk_hits']}/未命中{ocr['misses']}），"
+            f"节省上游耗时：{ocr['saved_seconds']:.1f}秒"
+        )
+        if self._ocr_backend_wins:
+            lines.append("识别来源：" + "，".join(f"{name}{count}次" for name, count in self._ocr_backend_wins.items()))
+        for label, tracker in self._ocr_latency.items():
+            if len(tracker):
+                lines.append(
+                    f"{label}识别耗时：P50 {tracker.percentile(0.5):.2f}秒，"
+                    f"P95 {tracker.percentile(0.95):.2f}秒（{len(tracker)}次）"
+                )
+        lines.append("")
+        
+        render = self.render_cache.stats()
+        lines.append("【渲染缓存】")
+        lines.append(
+            f"内存条目：{render['entries']}，占用：{render['bytes']}字节，命中率：{render['hit_rate']:.1%}"
+            f"（内存命中{render['memory_hits']}/磁盘命中{render['disk_hits']}/未命中{render['misses']}），淘汰：{render['evictions']}"
+        )
+        lines.append("")
+        
+        slots = self._render_slots.stats()
+        lines.append("【渲染调度】（菜单图片）")
+        lines.append(
+            f"运行{slots['active']}/{slots['limit']}，排队{slots['waiting']}/{slots['max_queue']}（峰值{slots['peak_waiting']}），"
+            f"拒绝{slots['rejected']}，平均排队{slots['avg_wait']:.2f}秒"
+        )
+        lines.append(f"渲染引擎：{'本地绘制' if self._local_render_enabled() else 'HTML渲染'}")
+        for label, tracker in (("HTML渲染", self._render_latency), ("本地绘制", self._local_render_latency)):
+            if len(tracker):
+                lines.append(
+                    f"{label}耗时：P50 {tracker.percentile(0.5):.2f}秒，"
+                    f"P95 {tracker.percentile(0.95):.2f}秒（{len(tracker)}次）"
+                )
+        lines.append("")
+        
+        encode = self.encode_stats.stats()
+        lines.append("【图片编码】")
+        lines.append(
+            f"编码：{encode['images']}张 -> {encode['pages']}页，{encode['original_bytes']}字节 -> {encode['encoded_bytes']}字节"
+            f"（节省{encode['saved_bytes']}字节），平均耗时{encode['avg_seconds']:.3f}秒，失败{encode['failures']}"
+        )
+        lines.append("")
+        
+        lines.append("【解题流水线】")
+        lines.append(f"处理中的请求：{self._jobs_in_flight}")
+        lines.append(
+            f"等待图片的会话：{len(self.waiting_sessions)}/{WAITING_MAX_SESSIONS}，"
+            f"超时{self.waiting_sessions.expired}，淘汰{self.waiting_sessions.evicted}"
+        )
+        for stage in self._pipeline.values():
+            stats = stage.stats()
+            line = (
+                f"{stage.name}：运行{stats['active']}/{stats['workers']}，排队{stats['waiting']}/{stats['max_queue']}"
+                f"（峰值{stats['peak_waiting']}），完成{stats['completed']}，失败{stats['failed']}，拒绝{stats['rejected']}，"
+                f"平均排队{stats['avg_wait']:.2f}秒"
+            )
+            if len(stage.latency):
+                line += f"，耗时P50 {stage.latency.percentile(0.5):.2f}秒/P95 {stage.latency.percentile(0.95):.2f}秒"
+            lines.append(line)
+        lines.append("")
+        
+        lines.append("【请求合并】")
+        lines.append(f"实际请求：{self._flights.started}，合并请求：{self._flights.coalesced}，进行中：{len(self._flights)}")
+        lines.append("")
+        
+        lines.append("【重试与对冲】")
+        stats = self._request_stats
+        lines.append(f"重试：{stats['retries']}，对冲请求：{stats['hedges']}，对冲胜出：{stats['hedge_wins']}")
+        for name, tracker in self._latencies.items():
+            p50 = tracker.percentile(0.5)
+            p95 = tracker.percentile(0.95)
+            if p95 is not None:
+                lines.append(f"{name}：P50 {p50:.2f}秒，P95 {p95:.2f}秒（{len(tracker)}个样本）")
+        lines.append("")
+        
+        lines.append("【最快模式】")
+        race = self.race_stats.stats()
+        for command, (count, avg) in sorted(race.items(), key=lambda item: -item[1][0]):
+            lines.append(f"{MODELS[command].name}：胜出{count}次，平均用时{avg:.2f}秒")
+        lines.append(f"全部失败：{self.race_stats.failures}次")
+        lines.append("")
+        
+        lines.append("【并发隔离】")
+        for name, bulkhead in self._bulkheads.items():
+            stats = bulkhead.stats()
+            lines.append(
+                f"{name}：运行{stats['active']}/{stats['limit']}，排队{stats['waiting']}/{stats['max_queue']}"
+                f"（峰值{stats['peak_waiting']}），拒绝{stats['rejected']}，"
+                f"平均等待{stats['avg_wait']:.2f}秒，最长等待{stats['max_wait']:.2f}秒"
+            )
+        if not self._bulkheads:
+            lines.append("暂无请求")
+        lines.append("")
+        
+        lines.append("【熔断状态】")
+        state_names = {
+            CircuitBreaker.CLOSED: "正常",
+            CircuitBreaker.OPEN: "熔断",
+            CircuitBreaker.HALF_OPEN: "探测中",
+        }
+        for name, breaker in self._breakers.items():
+            stats = breaker.stats()
+            line = (
+                f"{name}：{state_names[stats['state']]}，连续失败{stats['failures']}，"
+                f"累计失败{stats['total_failures']}，熔断{stats['open_count']}次，快速失败{stats['rejected']}"
+            )
+            if stats["state"] == CircuitBreaker.OPEN:
+                line += f"，约{stats['retry_after']:.0f}秒后探测"
+            lines.append(line)
+        if not self._breakers:
+            lines.append("暂无请求")
+        return "\n".join(lines)
+
     @filter.event_message_type(filter.EventMessageType.ALL)
     async def on_message(self, event: AstrMessageEvent):
-        """监听所有消息，处理等待中的图片请求"""
+        """监听所有消息，只把登记过的会话中的消息交给对应的处理函数"""
+        handler = self.dispatcher.match(event.unified_msg_origin, event.get_sender_id())
+        if handler is None:
+            return
+        await handler(event)
+
+    async def _on_waiting_image(self, event: AstrMessageEvent):
+        """处理等待中的图片请求"""
+        umo = event.unified_msg_origin
         user_id = event.get_sender_id()
         
-        # 检查用户是否在等待图片
-        if user_id not in self.waiting_sessions:
+        # 检查用户是否在当前会话中等待图片
+        if self.waiting_sessions.get(umo, user_id) is None:
             return
         
         # 提取图片URL
-        image_url = await self.extract_image_from_event(event)
-        if not image_url:
+        image_urls = await self.extract_images_from_event(event)
+        if not image_urls:
             return  # 不是图片消息，继续等待
         
-        # 找到图片，开始处理
-        original_event = self.waiting_sessions[user_id]["event"]
-        
-        # 清理会话和超时任务
-        del self.waiting_sessions[user_id]
-        if user_id in self.timeout_tasks:
-            self.timeout_tasks[user_id].cancel()
-            del self.timeout_tasks[user_id]
-        
-        # 处理图片解题
-        async for result in self.process_image_question_solving(original_event, image_url):
-            await original_event.send(result)
+        # 找到图片，结束等待并开始处理（结果发送到同一会话）
+        self.waiting_sessions.discard(umo, user_id)
+        async for result in self.process_image_question_solving(event, image_urls):
+            await event.send(result)
@@ -0,0 +1,88 @@
+"""测试环境：未安装AstrBot/aiohttp时为导入main.py提供最小的替身模块"""
+import enum
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _module(name: str, **attrs) -> types.ModuleType:
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    parent, _, child = name.rpartition(".")
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+def _decorator(*args, **kwargs):
+    return lambda target: target
+
+
+def _stub_astrbot():
+    class Star:
+        def __init__(self, context):
+            self.context = context
+
+    class CommandResult:
+        def message(self, text):
+            self.text = text
+            return self
+
+        def error(self, text):
+            self.text = text
+            return self
+
+    class Component:
+        def __init__(self, *args, **kwargs):
+            self.args = args
+            self.kwargs = kwargs
+
+    _module("astrbot")
+    _module("astrbot.api")
+    _module(
+        "astrbot.api.all",
+        AstrMessageEvent=type("AstrMessageEvent", (), {}),
+        CommandResult=CommandResult,
+        Context=type("Context", (), {}),
+        MessageChain=type("MessageChain", (Component,), {}),
+        Plain=type("Plain", (Component,), {}),
+    )
+    _module("astrbot.api.event")
+    _module(
+        "astrbot.api.event.filter",
+        command=_decorator,
+        event_message_type=_decorator,
+        permission_type=_decorator,
+        EventMessageType=enum.Enum("EventMessageType", "ALL"),
+        PermissionType=enum.Enum("PermissionType", "ADMIN"),
+    )
+    _module("astrbot.api.star", register=_decorator, Star=Star)
+    _module(
+        "astrbot.api.message_components",
+        Image=type("Image", (Component,), {}),
+        Reply=type("Reply", (Component,), {}),
+    )
+
+
+def _stub_aiohttp():
+    _module(
+        "aiohttp",
+        ClientError=type("ClientError", (Exception,), {}),
+        ClientSession=type("ClientSession", (), {}),
+        ClientTimeout=type("ClientTimeout", (), {}),
+        TCPConnector=type("TCPConnector", (), {}),
+    )
+
+
+try:
+    import astrbot.api.all  # noqa: F401
+except ImportError:
+    _stub_astrbot()
+
+try:
+    import aiohttp  # noqa: F401
+except ImportError:
+    _stub_aiohttp()
@@ -0,0 +1,90 @@
+"""SingleFlight 请求合并的测试：同一批并发请求只向上游发起一次"""
+import asyncio
+
+import main
+
+
+def test_burst_makes_one_upstream_call():
+    calls = []
+
+    async def factory():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "结果"
+
+    async def scenario():
+        flight = main.SingleFlight()
+        results = await asyncio.gather(*(flight.do("key", factory) for _ in range(20)))
+        return flight, results
+
+    flight, results = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert results == ["结果"] * 20
+    assert flight.started == 1
+    assert flight.coalesced == 19
+    assert len(flight) == 0
+
+
+def test_error_is_shared_by_all_waiters():
+    calls = []
+
+    async def factory():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        raise ValueError("上游失败")
+
+    async def scenario():
+        flight = main.SingleFlight()
+        return await asyncio.gather(*(flight.do("key", factory) for _ in range(5)), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_cancelling_last_waiter_cancels_upstream():
+    upstream = {}
+
+    async def factory():
+        upstream["task"] = asyncio.current_task()
+        await asyncio.sleep(10)
+
+    async def scenario():
+        flight = main.SingleFlight()
+        waiters = [asyncio.ensure_future(flight.do("key", factory)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        # 取消部分等待者时上游请求继续执行
+        waiters[0].cancel()
+        waiters[1].cancel()
+        await asyncio.sleep(0.01)
+        assert not upstream["task"].done()
+        # 最后一个等待者离开后上游请求被取消
+        waiters[2].cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.sleep(0)
+        return flight
+
+    flight = asyncio.run(scenario())
+    assert upstream["task"].cancelled()
+    assert len(flight) == 0
+
+
+def test_new_caller_does_not_join_cancelled_call():
+    calls = []
+
+    async def factory():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return len(calls)
+
+    async def scenario():
+        flight = main.SingleFlight()
+        waiter = asyncio.ensure_future(flight.do("key", factory))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        # 上游任务仍在取消过程中，新的请求应当重新发起而不是收到CancelledError
+        return await flight.do("key", factory)
+
+    assert asyncio.run(scenario()) == 2
+    assert len(calls) == 2